@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+
+"""
+benchmark.py -- local benchmark suite for the Conference Central API,
+    run on the App Engine testbed service stubs
+
+Seeds a synthetic dataset into the datastore_v3, memcache, taskqueue and
+user stubs, calls every ConferenceApi method directly and reports p50/p95
+latency, datastore RPC counts and memcache hit ratio per endpoint.  Results
+are written as JSON so runs can be compared across commits.  Calls issuing
+more write RPCs than WRITE_BUDGETS allows are reported as violations and
+make the run exit non-zero, as does a @unitOfWork handler without a
+budget.
+
+The stubs answer RPCs in-process, one after another, so overlapping RPCs
+save no time here.  Each call's RPC round trips are counted instead (RPCs
+issued before any of them completes share one), and --rpc-latency adds
+that many network delays to model production latency.  --baseline
+reports each endpoint's change against an earlier run's JSON.
+
+usage:
+    python benchmark.py --sdk ~/google_appengine \\
+        --conferences 50 --sessions 10 --speakers 40 --profiles 200 \\
+        --iterations 50 --output bench.json
+    python benchmark.py --sdk ~/google_appengine --rpc-latency 5 \\
+        --baseline bench.json
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import timeit
+from datetime import date, datetime, time, timedelta
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin', 'Sydney']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['lecture', 'workshop', 'keynote']
+WORDS = ['hope', 'scale', 'cloud', 'data', 'design', 'future', 'python']
+AUTH_DOMAIN = 'gmail.com'
+
+WRITE_RPCS = ('datastore_v3.Put', 'datastore_v3.Delete',
+              'datastore_v3.Commit', 'taskqueue.BulkAdd')
+# most write RPCs a single call of these cases may issue; every
+# @unitOfWork handler needs one
+WRITE_BUDGETS = {
+    'getProfile': 0,
+    'saveProfile': 1,
+    'saveProfile:new': 1,       # new profile and its update, one put
+    'createSession': 3,         # put and batched task add, one commit
+    'createConference': 6,      # conference and stats puts, three task
+                                # adds, one commit
+    'createSpeaker': 1,
+}
+
+
+def setupSdk(sdk_path):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    try:
+        import endpoints
+    except ImportError:
+        for lib in sorted(glob.glob(os.path.join(sdk_path, 'lib',
+                                                 'endpoints-*'))):
+            sys.path.append(lib)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+
+def userEmail(i):
+    return 'user%d@example.com' % i
+
+
+def setUser(email):
+    """Make endpoints.get_current_user() return given user (None: anon)."""
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = AUTH_DOMAIN
+
+
+def percentile(values, pct):
+    """Return nearest-rank percentile of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+IMPORT_SCRIPT = """
+import sys, timeit
+sys.path[:0] = %r
+start = timeit.default_timer()
+import %s
+sys.stdout.write(repr(timeit.default_timer() - start))
+"""
+
+
+def importTime(module, runs):
+    """Return median cold import time (ms) of module in fresh interpreters."""
+    times = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_SCRIPT % (sys.path, module)],
+            cwd=APP_DIR)
+        times.append(float(out) * 1000.0)
+    return round(percentile(times, 50), 3)
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=APP_DIR).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# - - - RPC accounting - - - - - - - - - - - - - - - - - - - -
+
+class RpcRecorder(object):
+    """APIProxy hooks counting RPCs, round trips and memcache hits."""
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.round_trips = 0
+        self.in_flight = False      # RPCs issued since the last completed
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy = apiproxy_stub_map.apiproxy
+        apiproxy.GetPreCallHooks().Append('benchmark_pre', self.preCall)
+        apiproxy.GetPostCallHooks().Append('benchmark_post', self.postCall)
+
+    def preCall(self, service, call, request, response):
+        if self.enabled:
+            self.calls['%s.%s' % (service, call)] += 1
+            if not self.in_flight:
+                self.round_trips += 1
+                self.in_flight = True
+
+    def postCall(self, service, call, request, response):
+        self.in_flight = False
+        if self.enabled and service == 'memcache' and call == 'Get':
+            hits = response.item_size()
+            self.memcache_hits += hits
+            self.memcache_misses += request.key_size() - hits
+
+
+# - - - Synthetic dataset - - - - - - - - - - - - - - - - - - -
+
+class Dataset(object):
+    """Seed N conferences with M sessions each, K speakers and P profiles."""
+
+    def __init__(self, conferences, sessions, speakers, profiles, seed):
+        self.n_conferences = conferences
+        self.n_sessions = sessions
+        self.n_speakers = speakers
+        self.n_profiles = profiles
+        self.rand = random.Random(seed)
+
+    def seed(self):
+        from google.appengine.ext import ndb
+        from models import Conference, Profile, Session, Speaker
+
+        rand = self.rand
+        self.profiles = [ndb.Key(Profile, userEmail(i))
+                         for i in range(self.n_profiles)]
+        ndb.put_multi([Profile(key=k, displayName='User %d' % i,
+                               mainEmail=k.id(),
+                               teeShirtSize='NOT_SPECIFIED')
+                       for i, k in enumerate(self.profiles)])
+
+        self.speakers = ndb.put_multi([
+            Speaker(name='Speaker %d' % i, title='Dr',
+                    institute=rand.choice(CITIES) + ' University')
+            for i in range(self.n_speakers)])
+
+        confs = []
+        start = date.today() + timedelta(days=30)
+        for i in range(self.n_conferences):
+            p_key = self.profiles[i % self.n_profiles]
+            startDate = start + timedelta(days=rand.randint(0, 365))
+            confs.append(Conference(
+                parent=p_key,
+                name='Conference %d' % i,
+                description=' '.join(rand.sample(WORDS, 3)),
+                organizerUserId=p_key.id(),
+                topics=rand.sample(TOPICS, 2),
+                city=rand.choice(CITIES),
+                startDate=startDate,
+                month=startDate.month,
+                endDate=startDate + timedelta(days=2),
+                maxAttendees=self.n_profiles,
+                seatsAvailable=self.n_profiles))
+        self.conferences = ndb.put_multi(confs)
+        self.organizers = dict((c.key, c.organizerUserId) for c in confs)
+
+        sessions = []
+        for conf in confs:
+            for j in range(self.n_sessions):
+                sessions.append(Session(
+                    parent=conf.key,
+                    name='%s session %d' % (conf.name, j),
+                    highlights=rand.choice(WORDS),
+                    speaker=rand.sample(self.speakers,
+                                        min(2, len(self.speakers))),
+                    duration=rand.choice([30, 45, 60, 90]),
+                    typeOfSession=[rand.choice(SESSION_TYPES)],
+                    date=conf.startDate + timedelta(days=rand.randint(0, 2)),
+                    startTime=time(rand.randint(8, 20),
+                                   rand.choice([0, 15, 30, 45]))))
+        self.sessions = ndb.put_multi(sessions)
+
+    # helpers used by request builders
+    def user(self, i):
+        return userEmail(i % self.n_profiles)
+
+    def conference(self, i):
+        return self.conferences[i % len(self.conferences)]
+
+    def registration(self, i):
+        """Return unique (user, conference) pair for iteration i."""
+        return self.user(i), self.conference(i // self.n_profiles)
+
+    def session(self, i):
+        return self.sessions[i % len(self.sessions)]
+
+    def speaker(self, i):
+        return self.speakers[i % len(self.speakers)]
+
+
+# - - - Endpoint cases - - - - - - - - - - - - - - - - - - - -
+
+def endpointCases(data):
+    """Return ordered (method name, builder) pairs covering ConferenceApi.
+
+    Each builder takes the iteration number and returns (request, user
+    email or None).  A ':variant' suffix on the name labels an extra case
+    for the same method.  Order matters: unregisterFromConference undoes the
+    registrations made by registerForConference.
+    """
+    import conference as c
+    from protorpc import message_types
+    import models as m
+
+    def req(container, **kwargs):
+        cls = getattr(container, 'combined_message_class', container)
+        return cls(**kwargs)
+
+    void = message_types.VoidMessage
+    rand = random.Random(1)
+
+    def confForm(i):
+        return dict(name='Bench conference %d' % i,
+                    description='created by benchmark',
+                    topics=[rand.choice(TOPICS)],
+                    city=rand.choice(CITIES),
+                    startDate='2030-%02d-01' % (i % 12 + 1),
+                    endDate='2030-%02d-03' % (i % 12 + 1),
+                    maxAttendees=100)
+
+    def ownConf(i):
+        key = data.conference(i)
+        return key, data.organizers[key]
+
+    def updateConference(i):
+        key, owner = ownConf(i)
+        return req(c.CONF_POST_REQUEST, websafeConferenceKey=key.urlsafe(),
+                   description='updated %d' % i), owner
+
+    def createSession(i):
+        key, owner = ownConf(i)
+        return req(c.SESS_POST_REQUEST, websafeConferenceKey=key.urlsafe(),
+                   name='Bench session %d' % i, date='2030-01-01',
+                   startTime='10:00',
+                   speaker=[data.speaker(i).urlsafe()]), owner
+
+    def registration(container, requestId=None):
+        def build(i):
+            user, key = data.registration(i)
+            return req(container, websafeConferenceKey=key.urlsafe(),
+                       requestId=requestId and requestId % i), user
+        return build
+
+    def confGet(container):
+        def build(i):
+            return req(container,
+                       websafeConferenceKey=data.conference(i).urlsafe()), None
+        return build
+
+    return [
+        ('createConference', lambda i: (
+            req(m.ConferenceForm, **confForm(i)), data.user(i))),
+        ('updateConference', updateConference),
+        ('getConference', confGet(c.CONF_CACHED_GET_REQUEST)),
+        ('getConferenceDetail', lambda i: (
+            req(c.CONF_CACHED_GET_REQUEST,
+                websafeConferenceKey=data.conference(i).urlsafe()),
+            data.user(i))),
+        ('getConferencesCreated', lambda i: (void(), data.user(i))),
+        ('queryConferences', lambda i: (
+            req(m.ConferenceQueryForms, filters=[
+                m.ConferenceQueryForm(field='CITY', operator='EQ',
+                                      value=CITIES[i % len(CITIES)])]),
+            None)),
+        ('queryConferences:facets', lambda i: (
+            req(m.ConferenceQueryForms, facets=True, filters=[
+                m.ConferenceQueryForm(field='CITY', operator='EQ',
+                                      value=CITIES[i % len(CITIES)])]),
+            None)),
+        ('queryConferences:dates', lambda i: (
+            req(m.ConferenceQueryForms, filters=[
+                m.ConferenceQueryForm(field='START_DATE', operator='LT',
+                    value=str(date.today() + timedelta(days=60 + i)))]),
+            None)),
+        ('getConferenceChanges', lambda i: (
+            req(c.CHANGES_GET_REQUEST, since=(datetime.utcnow() - timedelta(
+                minutes=1)).strftime(c.WATERMARK_FORMAT)), None)),
+        ('getConferenceChanges:full', lambda i: (
+            req(c.CHANGES_GET_REQUEST), None)),
+        ('getUpcomingConferences', lambda i: (
+            req(c.UPCOMING_GET_REQUEST, days=90), None)),
+        ('createSpeaker', lambda i: (
+            req(m.SpeakerForm, name='Bench speaker %d' % i), data.user(i))),
+        ('getSpeakers', lambda i: (req(c.CACHED_GET_REQUEST), None)),
+        ('createSession', createSession),
+        ('getConferenceSessions', confGet(c.CONF_CACHED_GET_REQUEST)),
+        ('getConferenceSessionsByType', lambda i: (
+            req(c.SESS_TYPE_QUERY_REQUEST,
+                websafeConferenceKey=data.conference(i).urlsafe(),
+                type=SESSION_TYPES[i % len(SESSION_TYPES)]), None)),
+        ('getSessionsBySpeaker', lambda i: (
+            req(c.SESS_SPEAKER_QUERY_REQUEST,
+                websafeSpeakerKey=data.speaker(i).urlsafe()), None)),
+        ('addSessionToWishlist', lambda i: (
+            req(c.SESS_GET_REQUEST,
+                websafeSessionKey=data.session(i).urlsafe()), data.user(i))),
+        ('getSessionsInWishlist', lambda i: (
+            req(c.WISHLIST_GET_REQUEST), data.user(i))),
+        ('getRecommendedSessions', lambda i: (req(c.SESS_GET_REQUEST,
+            websafeSessionKey=data.session(i).urlsafe()), None)),
+        ('getSessionsInWishlist:conflicts', lambda i: (
+            req(c.WISHLIST_GET_REQUEST, conflicts=True), data.user(i))),
+        ('getSessionsWithStartTimesWithin', lambda i: (
+            req(c.SESS_STARTTIME_QUERY_REQUEST,
+                websafeConferenceKey=data.conference(i).urlsafe(),
+                date=str(data.conference(i).get().startDate),
+                startTime='1200', window=120), None)),
+        ('getSessionsByDateAndCity', lambda i: (
+            req(c.SESS_DATE_CITY_QUERY_REQUEST,
+                date=str(data.conference(i).get().startDate),
+                city=CITIES[i % len(CITIES)]), None)),
+        ('getSessionsBeforeStartTimeNoType', lambda i: (
+            req(c.SESS_PUZZLE_QUERY_REQUEST, type='workshop',
+                startTime='1900'), None)),
+        ('getProfile', lambda i: (void(), data.user(i))),
+        ('saveProfile', lambda i: (
+            req(m.ProfileMiniForm, displayName='User %d' % i),
+            data.user(i))),
+        ('saveProfile:new', lambda i: (
+            req(m.ProfileMiniForm, displayName='New user %d' % i,
+                teeShirtSize=m.TeeShirtSize.M_W),
+            'newuser%d@%s' % (i, AUTH_DOMAIN))),
+        ('getAnnouncement', lambda i: (req(c.CACHED_GET_REQUEST), None)),
+        ('getFeaturedSpeaker', confGet(c.CONF_CACHED_GET_REQUEST)),
+        ('registerForConference', registration(
+            c.CONF_REGISTRATION_REQUEST, 'bench-%d')),
+        # client retries of the same requests, answered from memcache
+        ('registerForConference:retry', registration(
+            c.CONF_REGISTRATION_REQUEST, 'bench-%d')),
+        ('getConferencesToAttend', lambda i: (
+            void(), data.registration(i)[0])),
+        ('unregisterFromConference',
+            registration(c.CONF_REGISTRATION_REQUEST)),
+        ('filterPlayground', lambda i: (void(), None)),
+        ('getConferenceStats', lambda i: (void(), None)),
+        ('getConferencesByKeys', lambda i: (req(c.KEYS_GET_REQUEST,
+            websafeKeys=[data.conference(i + j).urlsafe()
+                         for j in range(10)]), None)),
+        ('getSessionsByKeys', lambda i: (req(c.KEYS_GET_REQUEST,
+            websafeKeys=[data.session(i + j).urlsafe()
+                         for j in range(10)]), None)),
+        ('getSpeakersByKeys', lambda i: (req(c.KEYS_GET_REQUEST,
+            websafeKeys=[data.speaker(i + j).urlsafe()
+                         for j in range(10)]), None)),
+        ('searchConferences', lambda i: (req(c.SEARCH_REQUEST,
+            query='%s %s*' % (CITIES[i % len(CITIES)],
+                              TOPICS[i % len(TOPICS)][:4])), None)),
+        ('searchSessions', lambda i: (req(c.SEARCH_REQUEST,
+            query='session ' + WORDS[i % len(WORDS)]), None)),
+    ]
+
+
+# - - - Runner - - - - - - - - - - - - - - - - - - - - - - - -
+
+class Benchmark(object):
+    """Drive ConferenceApi methods against the testbed stubs."""
+
+    def __init__(self, args):
+        self.args = args
+
+    def setUp(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # strongly consistent so seeded data is visible to every query
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.testbed.init_user_stub()
+
+        self.recorder = RpcRecorder()
+        self.recorder.install()
+        # keep rpcstats' periodic memcache flush out of the measurements
+        import rpcstats
+        rpcstats.FLUSH_INTERVAL = None
+        # keep admission control on every path it guards, but never reject
+        import ratelimit
+        ratelimit.LIMITS = dict(
+            (method, dict((scope, (1e6, 1e6)) for scope in limits))
+            for method, limits in ratelimit.LIMITS.items())
+
+        args = self.args
+        self.data = Dataset(args.conferences, args.sessions, args.speakers,
+                            args.profiles, args.seed)
+        self.data.seed()
+        # derived data the API would have maintained for seeded entities
+        from conference import ConferenceApi
+        import textsearch
+        ConferenceApi._rebuildConferenceStats()
+        ConferenceApi._rebuildUpcoming()
+        for key in self.data.conferences + self.data.sessions:
+            textsearch.indexDocument(key.urlsafe())
+
+    def startup(self):
+        """Measure cold imports and the /_ah/warmup handler."""
+        runs = self.args.startup_runs
+        results = {
+            'import_main_ms': importTime('main', runs),
+            'import_models_ms': importTime('models', runs),
+            'import_conference_ms': importTime('conference', runs),
+        }
+        import main
+        start = timeit.default_timer()
+        response = main.app.get_response('/_ah/warmup')
+        results['warmup_ms'] = round(
+            (timeit.default_timer() - start) * 1000.0, 3)
+        results['warmup_status'] = response.status_int
+        return results
+
+    def storage(self, registrations=10):
+        """Compare profile sizes with legacy and key-list registrations."""
+        from models import Profile
+        data = self.data
+        c_keys = [data.conference(i) for i in range(registrations)]
+        legacy = Profile(key=data.profiles[0], displayName='User 0',
+                         mainEmail=data.profiles[0].id(),
+                         conferenceKeysToAttend=[k.urlsafe() for k in c_keys])
+        compact = Profile(key=data.profiles[0], displayName='User 0',
+                          mainEmail=data.profiles[0].id(),
+                          conferencesToAttend=c_keys)
+
+        def sizes(prof):
+            pb = prof._to_pb()
+            return {
+                'entity_bytes': len(pb.Encode()),
+                'indexed_values': pb.property_size(),
+                'indexed_bytes': sum(len(p.Encode())
+                                     for p in pb.property_list()),
+            }
+        return {'registrations': registrations,
+                'legacy': sizes(legacy), 'keys': sizes(compact)}
+
+    def admission(self, calls=10000):
+        """Measure ratelimit.admit() cost per call and its memcache use."""
+        import ratelimit
+        saved = ratelimit.LIMITS
+        cases = [
+            ('unlimited', {}),
+            ('leased', {'bench': {'user': (1e6, 1e6), 'global': (1e6, 1e6)}}),
+            ('unleased', {'bench': {'user': (1e6, 1), 'global': (1e6, 1)}}),
+            ('rejected', {'bench': {'user': (1e-6, 1)}}),
+        ]
+        results = {}
+        try:
+            for name, limits in cases:
+                ratelimit.LIMITS = limits
+                ratelimit.reset()
+                self.recorder.reset()
+                self.recorder.enabled = True
+                rejected = 0
+                start = timeit.default_timer()
+                for i in range(calls):
+                    try:
+                        ratelimit.admit('bench', 'user@' + AUTH_DOMAIN)
+                    except ratelimit.ServiceUnavailableException:
+                        rejected += 1
+                elapsed = timeit.default_timer() - start
+                self.recorder.enabled = False
+                results[name] = {
+                    'us_per_call': round(elapsed * 1e6 / calls, 3),
+                    'memcache_ops_per_call': round(sum(
+                        v for k, v in self.recorder.calls.items()
+                        if k.startswith('memcache.')) / float(calls), 4),
+                    'rejected': rejected,
+                }
+        finally:
+            ratelimit.LIMITS = saved
+            ratelimit.reset()
+        return results
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def call(self, api, name, request, user):
+        """Time one call as if it were a fresh request; return stats."""
+        from google.appengine.ext import ndb
+        from protorpc import remote
+
+        setUser(user)
+        # each real request gets a new ndb context; drop its cache
+        ndb.get_context().clear_cache()
+        self.recorder.reset()
+        self.recorder.enabled = True
+        error = None
+        start = timeit.default_timer()
+        try:
+            getattr(api, name)(request)
+        except remote.ApplicationError as e:
+            error = type(e).__name__
+        finally:
+            elapsed = (timeit.default_timer() - start) * 1000.0
+            self.recorder.enabled = False
+        return elapsed, error, self.recorder
+
+    def run(self):
+        from conference import ConferenceApi
+
+        api = ConferenceApi()
+        cases = endpointCases(self.data)
+        only = set(self.args.only or [])
+        results = collections.OrderedDict()
+
+        for name, build in cases:
+            if only and name not in only:
+                continue
+            latencies, errors = [], collections.Counter()
+            rpcs = collections.Counter()
+            hits = misses = maxWrites = 0
+            modelled, trips = [], 0
+            for i in range(self.args.iterations):
+                request, user = build(i)
+                elapsed, error, rec = self.call(api, name.split(':')[0],
+                                                request, user)
+                latencies.append(elapsed)
+                modelled.append(elapsed + rec.round_trips *
+                                self.args.rpc_latency)
+                trips += rec.round_trips
+                if error:
+                    errors[error] += 1
+                rpcs.update(rec.calls)
+                hits += rec.memcache_hits
+                misses += rec.memcache_misses
+                maxWrites = max(maxWrites,
+                                sum(rec.calls[k] for k in WRITE_RPCS))
+            results[name] = self.summarize(latencies, errors, rpcs,
+                                           hits, misses)
+            results[name]['write_rpcs_max'] = maxWrites
+            results[name]['rpc_round_trips_per_call'] = round(
+                trips / float(len(latencies)), 2)
+            if self.args.rpc_latency:
+                results[name]['modelled_p50_ms'] = round(
+                    percentile(modelled, 50), 3)
+                results[name]['modelled_p95_ms'] = round(
+                    percentile(modelled, 95), 3)
+
+        covered = set(name.split(':')[0] for name, _ in cases)
+        skipped = sorted(set(ConferenceApi.all_remote_methods()) - covered)
+        return results, skipped
+
+    @staticmethod
+    def compare(results, baseline):
+        """Return per-endpoint changes in latency and round trips."""
+        metrics = ('p50_ms', 'p95_ms', 'modelled_p50_ms',
+                   'rpc_round_trips_per_call', 'datastore_rpcs_per_call')
+        changes = {}
+        for name, r in results.items():
+            old = baseline.get('endpoints', {}).get(name)
+            if not old:
+                continue
+            changes[name] = dict((m, round(r[m] - old[m], 3))
+                                 for m in metrics if m in r and m in old)
+        return changes
+
+    @staticmethod
+    def writeBudgets(results, only=None):
+        """Return cases whose calls issued more write RPCs than allowed.
+
+        A @unitOfWork handler with no budget, or whose budgeted case
+        didn't run (unless the run was limited to --only methods), is a
+        violation too.
+        """
+        import unitofwork
+        violations = dict((name, {'budget': WRITE_BUDGETS[name],
+                                  'max': r['write_rpcs_max']})
+                          for name, r in results.items()
+                          if name in WRITE_BUDGETS and
+                          r['write_rpcs_max'] > WRITE_BUDGETS[name])
+        for name in unitofwork.HANDLERS:
+            if name not in WRITE_BUDGETS or \
+                    (not only and name not in results):
+                violations[name] = {'budget': WRITE_BUDGETS.get(name),
+                                    'max': None}
+        return violations
+
+    @staticmethod
+    def summarize(latencies, errors, rpcs, hits, misses):
+        n = float(len(latencies))
+        datastore = dict((k.split('.', 1)[1], round(v / n, 2))
+                         for k, v in rpcs.items()
+                         if k.startswith('datastore_v3.'))
+        writes = dict((k, round(rpcs[k] / n, 2)) for k in WRITE_RPCS
+                      if rpcs[k])
+        memcache_ops = sum(v for k, v in rpcs.items()
+                           if k.startswith('memcache.'))
+        return {
+            'calls': len(latencies),
+            'errors': dict(errors),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'mean_ms': round(sum(latencies) / n, 3),
+            'datastore_rpcs': datastore,
+            'datastore_rpcs_per_call': round(sum(datastore.values()), 2),
+            'memcache_ops_per_call': round(memcache_ops / n, 2),
+            'write_rpcs': writes,
+            'memcache_hit_ratio': (round(hits / float(hits + misses), 3)
+                                   if hits + misses else None),
+        }
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to google_appengine SDK '
+                             '(default: $APPENGINE_SDK)')
+    parser.add_argument('--conferences', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=20)
+    parser.add_argument('--profiles', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='calls per endpoint')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--startup-runs', type=int, default=3,
+                        help='fresh interpreters per import timing '
+                             '(0 skips startup measurements)')
+    parser.add_argument('--only', nargs='*', metavar='METHOD',
+                        help='only benchmark these methods')
+    parser.add_argument('--rpc-latency', type=float, default=0,
+                        metavar='MS', help='model this network latency per '
+                                           'RPC round trip')
+    parser.add_argument('--baseline', type=argparse.FileType('r'),
+                        help="compare with a previous run's JSON results")
+    parser.add_argument('--output', help='write JSON results here '
+                                         '(default: stdout)')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or $APPENGINE_SDK is required')
+    return args
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    setupSdk(args.sdk)
+
+    bench = Benchmark(args)
+    bench.setUp()
+    try:
+        startup = bench.startup() if args.startup_runs else None
+        endpoints, skipped = bench.run()
+        storage = bench.storage()
+        admission = bench.admission()
+    finally:
+        bench.tearDown()
+
+    report = {
+        'revision': gitRevision(),
+        'dataset': {
+            'conferences': args.conferences,
+            'sessions_per_conference': args.sessions,
+            'speakers': args.speakers,
+            'profiles': args.profiles,
+            'seed': args.seed,
+        },
+        'iterations': args.iterations,
+        'rpc_latency_ms': args.rpc_latency,
+        'endpoints': endpoints,
+        'skipped': skipped,
+        'startup': startup,
+        'profile_storage': storage,
+        'admission': admission,
+        'write_budget_violations': bench.writeBudgets(endpoints,
+                                                       args.only),
+    }
+    if args.baseline:
+        report['vs_baseline'] = bench.compare(endpoints,
+                                              json.load(args.baseline))
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    if report['write_budget_violations']:
+        sys.exit('write budget exceeded: %s' % ', '.join(
+            sorted(report['write_budget_violations'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+build_static.py -- bundle the web client's JavaScript, partials and CSS
+    into content-hashed files
+
+Concatenates and minifies static/js (plus the Angular partials, preloaded
+into $templateCache so routes and the login modal need no extra requests)
+and the app's CSS into static/dist/app.<hash>.js and app.<hash>.css, then
+rewrites the marked blocks of templates/index.html to load them.  The
+hash changes whenever the content does, so app.yaml serves /dist with a
+far-future expiration and browsers never revalidate; index.html itself is
+served uncached.  Run it before every deploy.
+
+Minification is conservative: comments, indentation and blank lines go,
+line breaks stay, so statements never merge.
+
+usage:
+    python build_static.py           # build bundles, point index.html at them
+    python build_static.py --dev     # point index.html back at the sources
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DIST_DIR = os.path.join(APP_DIR, 'static', 'dist')
+DIST_URL = '/dist/'
+INDEX = os.path.join(APP_DIR, 'templates', 'index.html')
+
+# (url, file) in load order; urls are those app.yaml serves the sources at
+JS_SOURCES = [
+    ('/js/app.js', 'static/js/app.js'),
+    ('/js/controllers.js', 'static/js/controllers.js'),
+]
+CSS_SOURCES = [     # bootstrap-cosmo.css first: it holds an @import
+    ('/css/bootstrap-cosmo.css', 'static/bootstrap/css/bootstrap-cosmo.css'),
+    ('/css/main.css', 'static/bootstrap/css/main.css'),
+    ('/css/offcanvas.css', 'static/bootstrap/css/offcanvas.css'),
+]
+PARTIALS_URL = '/partials/'
+PARTIALS_GLOB = 'static/partials/*.html'
+ANGULAR_MODULE = 'conferenceApp'
+
+BLOCK_RE = re.compile(r'(<!-- build:(js|css) -->\n)(.*?)([ \t]*<!-- endbuild -->)',
+                      re.S)
+JS_TAG = '<script src="%s"></script>'
+CSS_TAG = '<link rel="stylesheet" href="%s">'
+HASH_LENGTH = 10
+
+# a "/" after one of these (or at the start) opens a regex, not a division
+REGEX_PRECEDERS = set('(,=:[!&|?{};+-*%<>~^')
+
+# - - - Minifiers - - - - - - - - - - - - - - - - - - - - - - -
+
+def stripJsComments(source):
+    """Remove comments from JavaScript, leaving strings and regexes be."""
+    out = []
+    i, n = 0, len(source)
+    last = ''       # last significant character written
+    while i < n:
+        c = source[i]
+        nxt = source[i + 1] if i + 1 < n else ''
+        if c in '\'"':
+            j = i + 1
+            while j < n and source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j + 1])
+            i, last = j + 1, c
+        elif c == '/' and nxt == '/':
+            while i < n and source[i] != '\n':
+                i += 1
+        elif c == '/' and nxt == '*':
+            end = source.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            out.append('\n' if '\n' in source[i:end] else ' ')
+            i = end
+        elif c == '/' and (not last or last in REGEX_PRECEDERS):
+            j, inClass = i + 1, False
+            while j < n and (inClass or source[j] != '/'):
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    inClass = True
+                elif source[j] == ']':
+                    inClass = False
+                j += 1
+            out.append(source[i:j + 1])
+            i, last = j + 1, '/'
+        else:
+            out.append(c)
+            if not c.isspace():
+                last = c
+            i += 1
+    return ''.join(out)
+
+
+def minifyJs(source):
+    lines = (line.strip() for line in stripJsComments(source).split('\n'))
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+def minifyCss(source):
+    source = re.sub(r'/\*.*?\*/', '', source, flags=re.S)
+    source = re.sub(r'\s+', ' ', source)
+    source = re.sub(r'\s*([{};,>])\s*', r'\1', source)
+    return source.replace(';}', '}').strip() + '\n'
+
+
+def minifyHtml(source):
+    lines = (line.strip() for line in source.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+# - - - Bundles - - - - - - - - - - - - - - - - - - - - - - - -
+
+def read(path):
+    with io.open(os.path.join(APP_DIR, path), encoding='utf-8') as f:
+        return f.read()
+
+
+def templateCache():
+    """Return JavaScript putting every partial in $templateCache."""
+    puts = []
+    for path in sorted(glob.glob(os.path.join(APP_DIR, PARTIALS_GLOB))):
+        url = PARTIALS_URL + os.path.basename(path)
+        puts.append('$templateCache.put(%s, %s);' % (
+            json.dumps(url), json.dumps(minifyHtml(read(path)))))
+    return ("angular.module('%s').run(['$templateCache', "
+            "function ($templateCache) {\n%s\n}]);\n"
+            % (ANGULAR_MODULE, '\n'.join(puts)))
+
+
+def writeBundle(name, ext, content):
+    """Write content to a hashed file in DIST_DIR; return its url."""
+    data = content.encode('utf-8')
+    digest = hashlib.sha1(data).hexdigest()[:HASH_LENGTH]
+    filename = '%s.%s.%s' % (name, digest, ext)
+    if not os.path.isdir(DIST_DIR):
+        os.makedirs(DIST_DIR)
+    # drop bundles of previous builds
+    for old in glob.glob(os.path.join(DIST_DIR, '%s.*.%s' % (name, ext))):
+        if os.path.basename(old) != filename:
+            os.remove(old)
+    with open(os.path.join(DIST_DIR, filename), 'wb') as f:
+        f.write(data)
+    return DIST_URL + filename
+
+
+def build():
+    """Write the bundles; return the tags index.html should load."""
+    js = ''.join(minifyJs(read(path)) for _, path in JS_SOURCES)
+    js += templateCache()
+    css = ''.join(minifyCss(read(path)) for _, path in CSS_SOURCES)
+    return {'js': [JS_TAG % writeBundle('app', 'js', js)],
+            'css': [CSS_TAG % writeBundle('app', 'css', css)]}
+
+
+def sources():
+    """Return the tags loading the unbundled sources, for development."""
+    return {'js': [JS_TAG % url for url, _ in JS_SOURCES],
+            'css': [CSS_TAG % url for url, _ in CSS_SOURCES]}
+
+
+def rewriteIndex(tags):
+    """Replace the contents of index.html's build blocks with tags."""
+    html = read(INDEX)
+
+    def replace(match):
+        indent = re.match(r'[ \t]*', match.group(4)).group(0)
+        return '%s%s%s' % (match.group(1),
+                           ''.join(indent + t + '\n'
+                                   for t in tags[match.group(2)]),
+                           match.group(4))
+    html, found = BLOCK_RE.subn(replace, html)
+    if found != 2:
+        raise SystemExit('%s: expected a build:js and a build:css block'
+                         % INDEX)
+    with io.open(INDEX, 'w', encoding='utf-8') as f:
+        f.write(html)
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dev', action='store_true',
+                        help='load the unbundled sources instead')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    tags = sources() if args.dev else build()
+    rewriteIndex(tags)
+    for tag in tags['css'] + tags['js']:
+        print(tag)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,33 +15,89 @@ forked from udacity/ud858 by MKM on 2015 May 22
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
-from datetime import datetime, timedelta, time
+from datetime import date, datetime, timedelta, time
+import bisect
+import hashlib
+import operator
+import pickle
+import random
+from time import sleep
+import zlib
 
 import endpoints
 from protorpc import messages, message_types, remote
 
-from google.appengine.api import memcache, taskqueue
+from google.appengine.api import datastore_errors, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from models import ConflictException, Profile, ProfileMiniForm, ProfileForm, \
-                   StringMessage, BooleanMessage, Conference, ConferenceForm, \
-                   ConferenceForms, ConferenceQueryForm, ConferenceQueryForms, \
-                   TeeShirtSize, Session, SessionForm, SessionForms, Speaker, \
-                   SpeakerForm, SpeakerForms
+from errors import ConflictException, ServiceUnavailableException
+from models import Announcement, \
+                   Profile, ProfileMiniForm, ProfileForm, StringMessage, \
+                   BooleanMessage, Conference, ConferenceForm, ConferenceForms, \
+                   ConferenceQueryForm, ConferenceQueryForms, TeeShirtSize, \
+                   Session, SessionForm, SessionForms, Speaker, SpeakerForm, \
+                   SpeakerForms, ConferenceStatsShard, ConferenceStatsForm, \
+                   StatCount, FacetCount, WaitlistEntry, WaitlistForm, \
+                   ConferenceResult, ConferenceResults, SessionResult, \
+                   SessionResults, SpeakerResult, SpeakerResults, \
+                   SessionRecommendation, UpcomingConferences, \
+                   ConferenceDetailForm, ConferenceChanges, \
+                   ConferenceTombstone
 
 from settings import WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID, \
                      ANDROID_AUDIENCE
 
 from utils import getUserId
+import intervals
+import textsearch
+import rpcstats
+from rpcstats import instrumented
+from ratelimit import ratelimited
+import unitofwork
+from unitofwork import unitOfWork
 
 import logging
 
+rpcstats.registerMetric('txn_retries')
+rpcstats.registerMetric('txn_failures')
+rpcstats.registerMetric('dedup_hits')
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 MEMCACHE_FEATURED_SPEAKERS_KEY = "FEATURED_SPEAKERS"
+MEMCACHE_VERSION_TPL = "VERSION_%s"
+MEMCACHE_REGISTRATION_TPL = "REGISTRATION_%s_%s_%s_%s"  # user, op, conf, id
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_ID = "nearly_sold_out"
+NEARLY_SOLD_OUT_SEATS = 5
+RECONCILE_SLACK = timedelta(minutes=5)
+RECONCILE_BATCH_SIZE = 20   # conferences per xg transaction (limit is 25)
+STATS_SHARDS = 20
+REGISTRATION_RESULT_TTL = 10 * 60   # seconds a requestId is remembered
+REGISTRATION_PENDING_TTL = 30       # seconds an in-flight marker lives
+REGISTRATION_ATTEMPTS = 5
+REGISTRATION_BACKOFF = 0.05         # seconds; doubled on each retry
+REGISTRATION_BACKOFF_CAP = 1.0
+MAX_BATCH_GET_KEYS = 100
+WAITLIST_BATCH_SIZE = 10    # 2 entity groups each; xg allows 25 in all
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+MEMCACHE_FACET_TABLE_TPL = "CONF_ATTRS_V2_%d"   # bump when columns change
+FACET_TABLE_CHUNKS = 16
+FACET_TABLE_TTL = 60 * 60   # bounds drift from missed updates
+UPCOMING_ID = "upcoming"
+UPCOMING_SIZE = 200         # conferences kept in the upcoming feed
+UPCOMING_DAYS = 30
+UPCOMING_MAX_LIMIT = 100
+CHANGES_PAGE_SIZE = 100
+CHANGES_SLACK = timedelta(minutes=5)    # commits in flight at the last call
+WATERMARK_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# the API frontend's first calls to a new instance, replayed by warmup
+WARMUP_SPI_CALLS = ('BackendService.getApiConfigs',
+                    'ConferenceApi.getAnnouncement')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -70,13 +126,56 @@ FIELDS =    {
             'TOPIC': 'topics',
             'MONTH': 'month',
             'MAX_ATTENDEES': 'maxAttendees',
+            'START_DATE': 'startDate',
+            'END_DATE': 'endDate',
+            }
+
+COMPARATORS = {
+            '=':  operator.eq,
+            '>':  operator.gt,
+            '>=': operator.ge,
+            '<':  operator.lt,
+            '<=': operator.le,
+            '!=': operator.ne,
             }
 
+# columns of the facet table rows; filterable FIELDS must all be here
+FACET_TABLE_FIELDS = ('city', 'topics', 'month', 'maxAttendees',
+                      'startDate', 'endDate')
+FACETS = ('CITY', 'TOPIC', 'MONTH')
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_REGISTRATION_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    requestId=messages.StringField(2),
+)
+
+WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    conflicts=messages.BooleanField(1),
+)
+
+KEYS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeKeys=messages.StringField(1, repeated=True),
+)
+
+CONF_CACHED_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    etag=messages.StringField(2),
+)
+
+CACHED_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    etag=messages.StringField(1),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -123,6 +222,25 @@ SESS_PUZZLE_QUERY_REQUEST = endpoints.ResourceContainer(
     startTime=messages.StringField(2)
 )
 
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    pageToken=messages.StringField(3)
+)
+
+UPCOMING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    days=messages.IntegerField(1),
+    limit=messages.IntegerField(2),
+)
+
+CHANGES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    since=messages.StringField(1),
+    pageToken=messages.StringField(2),
+)
+
 FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
     websafeSessionKey=messages.StringField(2)
@@ -137,6 +255,79 @@ FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+# - - - Resource versions (ETags) - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _newVersion():
+        """Return a fresh version number (milliseconds since the epoch)."""
+        delta = datetime.utcnow() - datetime(1970, 1, 1)
+        return int(delta.total_seconds() * 1000)
+
+
+    @staticmethod
+    def _resourceVersion(*resources):
+        """Return version token (etag) for given resources from memcache.
+
+        Versions are generation counters bumped after every write, so a
+        client's etag can be checked without touching the datastore.  Read
+        the token *before* loading data: a concurrent write then only costs
+        the client one extra full response, never a stale one.
+        """
+        keys = [MEMCACHE_VERSION_TPL % r for r in resources]
+        versions = memcache.get_multi(keys)
+        missing = [k for k in keys if k not in versions]
+        if missing:
+            # counter evicted or never set; start a new generation that
+            # can't match any token handed out before the eviction
+            fresh = dict((k, ConferenceApi._newVersion()) for k in missing)
+            memcache.add_multi(fresh)
+            versions.update(fresh)
+        return '-'.join(str(versions[k]) for k in keys)
+
+
+    @staticmethod
+    def _bumpVersion(*resources):
+        """Invalidate etags for given resources once current write commits."""
+        def bump():
+            for r in resources:
+                memcache.incr(MEMCACHE_VERSION_TPL % r,
+                              initial_value=ConferenceApi._newVersion())
+        # after the transaction commits or the unit of work flushes;
+        # immediately otherwise
+        unitofwork.callOnCommit(bump)
+
+
+    @staticmethod
+    def _notModified(request, etag, responseType, **fields):
+        """Return a bodyless response if client already has this version.
+
+        Endpoints can't pass a 304 through to clients, so this is a 200
+        with notModified set; callers return it when it isn't None.
+        """
+        if request.etag and request.etag == etag:
+            return responseType(etag=etag, notModified=True, **fields)
+        return None
+
+# - - - Warmup - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _warmup():
+        """Prime per-instance state before the first user request."""
+        # send the calls the API frontend makes first through the WSGI
+        # app serving /_ah/spi, warming its dispatch and JSON paths
+        import webob
+        for call in WARMUP_SPI_CALLS:
+            response = webob.Request.blank(
+                '/_ah/spi/' + call, method='POST', body='{}',
+                headers={'Content-Type': 'application/json',
+                         'X-Appengine-Peer': 'apiserving'}).get_response(api)
+            if response.status_int != 200:
+                logging.warning('warmup: %s returned %s',
+                                call, response.status)
+
+        # open a datastore connection
+        Conference.query().get(keys_only=True)
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
@@ -172,6 +363,8 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -202,15 +395,26 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-            'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email'
-        )
+        conf = Conference(**data)
+
+        @ndb.transactional(xg=True)
+        def create():
+            conf.put()
+            self._trackNearlySoldOut(conf, False)
+            self._updateConferenceStats(self._conferenceCounters(conf))
+            textsearch.enqueueIndex(conf.key)
+            self._patchFacetTable(conf)
+            self._queueUpcomingUpdate(conf.key.urlsafe())
+            # transactional, so the email goes only for a stored conference
+            unitofwork.addTask(params={'email': user.email(),
+                'conferenceInfo': repr(request)},
+                url='/tasks/send_confirmation_email'
+            )
+        create()
         return request
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -232,12 +436,19 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        wasNearlySoldOut = self._isNearlySoldOut(conf)
+        oldName = conf.name
+        oldCounters = self._conferenceCounters(conf)
+        oldMaxAttendees = conf.maxAttendees or 0
+        oldStartDate = conf.startDate
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
             data = getattr(request, field.name)
             # only copy fields where we get data
-            if data not in (None, []):
+            if data not in (None, []) and \
+                    field.name not in ('etag', 'notModified', 'seatsAvailable'):
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -245,13 +456,33 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # seats follow capacity changes; registrations stay as they are
+        registered = oldMaxAttendees - (conf.seatsAvailable or 0)
+        if (conf.maxAttendees or 0) < registered:
+            raise endpoints.BadRequestException(
+                "'maxAttendees' can't be below the %d users registered."
+                % registered)
+        conf.seatsAvailable = (conf.maxAttendees or 0) - registered
+        if conf.maxAttendees > oldMaxAttendees:
+            self._queueWaitlistPromotion(conf.key.urlsafe())
         conf.put()
+        self._trackNearlySoldOut(conf, wasNearlySoldOut, oldName)
+        self._updateConferenceStats(self._conferenceCounters(conf),
+                                    oldCounters)
+        textsearch.enqueueIndex(conf.key)
+        self._patchFacetTable(conf)
+        if conf.startDate != oldStartDate:
+            self._queueUpcomingUpdate(conf.key.urlsafe())
+        self._bumpVersion('conf_' + conf.key.urlsafe())
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
+    @instrumented
+    @ratelimited
+    @unitOfWork
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -260,29 +491,93 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_CACHED_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        # conference form includes organizer's displayName, so the etag
+        # covers both the conference and its parent profile
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag = self._resourceVersion('conf_' + c_key.urlsafe(),
+                                     'profile_%s' % c_key.parent().id())
+        notModified = self._notModified(request, etag, ConferenceForm)
+        if notModified:
+            return notModified
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
         prof = conf.key.parent().get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf.etag = etag
+        return cf
+
+
+    @endpoints.method(CONF_CACHED_GET_REQUEST, ConferenceDetailForm,
+            path='conference/{websafeConferenceKey}/detail',
+            http_method='GET', name='getConferenceDetail')
+    @instrumented
+    def getConferenceDetail(self, request):
+        """Return a conference with its sessions, featured speaker, the
+        announcement and whether the caller is attending, in one call."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        wsck = c_key.urlsafe()
+        user = endpoints.get_current_user()
+        p_key = user and ndb.Key(Profile, getUserId(user))
+        # registrations bump the conference's version, and the caller's
+        # id is part of the etag, so it also covers the attending flag
+        etag = self._resourceVersion('conf_' + wsck,
+                                     'profile_%s' % c_key.parent().id(),
+                                     'sessions_' + wsck, 'featured_' + wsck,
+                                     'announcement')
+        etag += '-' + (hashlib.sha1(p_key.id().encode('utf-8'))
+                       .hexdigest()[:12] if p_key else 'anon')
+        notModified = self._notModified(request, etag, ConferenceDetailForm)
+        if notModified:
+            return notModified
+
+        # issue every RPC before waiting on any; the gets go out as one
+        # batch, alongside the session query and memcache reads
+        gets = ndb.get_multi_async([c_key, c_key.parent()] +
+                                   ([p_key] if p_key else []))
+        sessions = Session.query(ancestor=c_key).fetch_async()
+        featured = self._getFeaturedSpeakerAsync(wsck)
+        announcement = self._getAnnouncementAsync()
+
+        conf = gets[0].get_result()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        organizer = gets[1].get_result()
+        detail = ConferenceDetailForm(
+            conference=self._copyConferenceToForm(
+                conf, getattr(organizer, 'displayName', None)),
+            sessions=[self._copySessionToForm(s)
+                      for s in sessions.get_result()],
+            featuredSpeaker=featured.get_result(),
+            announcement=announcement.get_result(),
+            etag=etag)
+        if p_key:
+            prof = gets[2].get_result()
+            detail.attending = bool(prof) and c_key in prof.attending()
+        return detail
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -291,12 +586,14 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        # run ancestor query for all key matches for this user
+        # while getting the user's profile
+        p_key = ndb.Key(Profile, user_id)
+        confs = Conference.query(ancestor=p_key).fetch_async()
+        prof = p_key.get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs.get_result()]
         )
 
 
@@ -313,13 +610,30 @@ class ConferenceApi(remote.Service):
             q = q.order(Conference.name)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
+            value = self._filterValue(filtr)
+            if isinstance(value, date):
+                # dates are stored as datetimes at midnight
+                value = datetime.combine(value, time())
+            formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], value)
             q = q.filter(formatted_query)
         return q
 
 
+    @staticmethod
+    def _filterValue(filtr):
+        """Convert a formatted filter's value to its field's type."""
+        try:
+            if filtr["field"] in ["month", "maxAttendees"]:
+                return int(filtr["value"])
+            if filtr["field"] in ["startDate", "endDate"]:
+                return datetime.strptime(filtr["value"][:10],
+                                         "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            raise endpoints.BadRequestException(
+                "Invalid value for %s: %s" % (filtr["field"], filtr["value"]))
+        return filtr["value"]
+
+
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
         formatted_filters = []
@@ -352,6 +666,8 @@ class ConferenceApi(remote.Service):
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @instrumented
+    @ratelimited
     def queryConferences(self, request):
         """Query for conferences."""
         conferences = self._getQuery(request)
@@ -367,10 +683,401 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
+        cf = ConferenceForms(
                 items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
                 conferences]
         )
+        if request.facets:
+            cf.facets = self._facetCounts(request.filters)
+        return cf
+
+# - - - Conference facets - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _facetRow(conf):
+        """Return compact facet table row for a conference."""
+        return [getattr(conf, field) for field in FACET_TABLE_FIELDS]
+
+
+    @staticmethod
+    def _facetChunkKey(websafeConferenceKey):
+        return MEMCACHE_FACET_TABLE_TPL % (
+            zlib.crc32(websafeConferenceKey) % FACET_TABLE_CHUNKS)
+
+
+    @staticmethod
+    def _patchFacetTable(conf):
+        """Update conference's facet table row once current write commits."""
+        wsck = conf.key.urlsafe()
+        key = ConferenceApi._facetChunkKey(wsck)
+        row = ConferenceApi._facetRow(conf)
+
+        def patch():
+            client = memcache.Client()
+            for attempt in range(3):
+                chunk = client.gets(key)
+                if chunk is None:
+                    return      # rebuilt from the datastore when next read
+                chunk[wsck] = row
+                if client.cas(key, chunk, time=FACET_TABLE_TTL):
+                    return
+            memcache.delete(key)
+        ndb.get_context().call_on_commit(patch)
+
+
+    @staticmethod
+    def _invalidateFacetTable():
+        """Drop the facet table, e.g. after a bulk update of conferences."""
+        memcache.delete_multi([MEMCACHE_FACET_TABLE_TPL % i
+                               for i in range(FACET_TABLE_CHUNKS)])
+
+
+    @staticmethod
+    def _getFacetTable():
+        """Return {websafeConferenceKey: row} for all conferences.
+
+        The table is split over FACET_TABLE_CHUNKS memcache values.  If
+        all are missing they're rebuilt with one pass over Conference;
+        if only some were evicted, a keys-only pass picks the conferences
+        to get for those.
+        """
+        keys = [MEMCACHE_FACET_TABLE_TPL % i
+                for i in range(FACET_TABLE_CHUNKS)]
+        chunks = memcache.get_multi(keys)
+        if len(chunks) < len(keys):
+            rebuilt = dict((k, {}) for k in keys if k not in chunks)
+            if chunks:
+                c_keys = [k for k in Conference.query().iter(
+                              keys_only=True, batch_size=1000)
+                          if ConferenceApi._facetChunkKey(k.urlsafe())
+                          in rebuilt]
+                confs = (conf for i in range(0, len(c_keys), 500)
+                         for conf in ndb.get_multi(c_keys[i:i + 500])
+                         if conf)
+            else:
+                confs = Conference.query().iter(batch_size=500)
+            for conf in confs:
+                wsck = conf.key.urlsafe()
+                chunk = rebuilt.get(ConferenceApi._facetChunkKey(wsck))
+                if chunk is not None:
+                    chunk[wsck] = ConferenceApi._facetRow(conf)
+            ConferenceApi._cacheFacetChunks(rebuilt)
+            chunks.update(rebuilt)
+
+        table = {}
+        for chunk in chunks.values():
+            table.update(chunk)
+        return table
+
+
+    @staticmethod
+    def _cacheFacetChunks(chunks):
+        """Add rebuilt facet table chunks to memcache; log any that fail."""
+        fitting = {}
+        for key, chunk in chunks.items():
+            size = len(pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL))
+            if size > memcache.MAX_VALUE_SIZE:
+                logging.error('facet table: %s is %d bytes, over the '
+                              'memcache limit; raise FACET_TABLE_CHUNKS',
+                              key, size)
+            else:
+                fitting[key] = chunk
+        # add, so chunks patched in the meantime aren't overwritten
+        notAdded = memcache.add_multi(fitting, time=FACET_TABLE_TTL)
+        if notAdded:
+            lost = set(notAdded) - set(memcache.get_multi(notAdded))
+            if lost:
+                logging.warning('facet table: memcache dropped %s',
+                                ', '.join(sorted(lost)))
+
+
+    def _facetCounts(self, filters):
+        """Return city, topic and month counts of conferences matching
+        the given query filters, computed from the facet table."""
+        filters = self._formatFilters(filters)[1]
+        for filtr in filters:
+            filtr["value"] = self._filterValue(filtr)
+            filtr["compare"] = COMPARATORS[filtr["operator"]]
+
+        counts = dict((facet, {}) for facet in FACETS)
+        for row in self._getFacetTable().values():
+            values = dict(zip(FACET_TABLE_FIELDS, row))
+            # like the datastore: a repeated property matches if any value
+            # does, and entities without the property never match
+            if not all(any(v is not None and filtr["compare"](v, filtr["value"])
+                           for v in self._asList(values[filtr["field"]]))
+                       for filtr in filters):
+                continue
+            for facet in FACETS:
+                for v in set(self._asList(values[FIELDS[facet]])):
+                    if v:
+                        counts[facet][v] = counts[facet].get(v, 0) + 1
+
+        return [FacetCount(field=facet, value=u'%s' % value, count=n)
+                for facet in FACETS
+                for value, n in sorted(counts[facet].items(),
+                                       key=lambda vn: (-vn[1], vn[0]))]
+
+
+    @staticmethod
+    def _asList(value):
+        return value if isinstance(value, list) else [value]
+
+# - - - Upcoming conferences - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _queueUpcomingUpdate(wsck):
+        """Queue moving a conference in the upcoming feed on commit.
+
+        The feed is one entity; updating it from a task keeps conference
+        writes from contending on it.
+        """
+        taskqueue.add(params={'websafeConferenceKey': wsck},
+                      url='/tasks/update_upcoming',
+                      transactional=ndb.in_transaction())
+
+
+    @staticmethod
+    def _queueUpcomingRebuild():
+        """Queue a rebuild of the upcoming feed, at most one a minute."""
+        try:
+            taskqueue.add(url='/crons/rebuild_upcoming', method='GET',
+                          name='rebuild-upcoming-' +
+                          datetime.utcnow().strftime('%Y%m%d%H%M'))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _updateUpcoming(wsck):
+        """Move a conference to its place in the upcoming feed."""
+        feed = ndb.Key(UpcomingConferences, UPCOMING_ID).get()
+        if not feed:
+            return      # the next rebuild includes it
+        conf = ndb.Key(urlsafe=wsck).get()
+        today = date.today().isoformat()
+        items = [i for i in feed.items if i[1] != wsck and i[0] >= today]
+        start = conf and conf.startDate and conf.startDate.isoformat()
+        # a rebuild keeps changes made after it queried
+        feed.changes = feed.changes or {}
+        feed.changes[wsck] = [start, datetime.utcnow().isoformat()]
+        if start and start >= today:
+            entry = [start, wsck]
+            # past the end of an incomplete feed we don't know the order
+            if feed.complete or (items and entry < items[-1]):
+                bisect.insort(items, entry)
+        if len(items) > UPCOMING_SIZE:
+            items = items[:UPCOMING_SIZE]
+            feed.complete = False
+        feed.items = items
+        feed.put()
+
+
+    @staticmethod
+    def _queryUpcoming():
+        """Return ([startDate, websafeKey] items, complete) by query."""
+        confs = Conference.query(Conference.startDate >= date.today()) \
+            .order(Conference.startDate) \
+            .fetch(UPCOMING_SIZE + 1, projection=[Conference.startDate])
+        return ([[c.startDate.isoformat(), c.key.urlsafe()]
+                 for c in confs[:UPCOMING_SIZE]],
+                len(confs) <= UPCOMING_SIZE)
+
+
+    @staticmethod
+    def _rebuildUpcoming():
+        """Recompute the upcoming feed with one query (cron and tasks)."""
+        started = datetime.utcnow().isoformat()
+        queried, complete = ConferenceApi._queryUpcoming()
+
+        @ndb.transactional()
+        def merge():
+            # the query replaces the feed, except for changes updates made
+            # after it ran, which it may not have seen
+            feed = ndb.Key(UpcomingConferences, UPCOMING_ID).get() or \
+                UpcomingConferences(id=UPCOMING_ID, items=[])
+            today = date.today().isoformat()
+            known = dict((wsck, start) for start, wsck in queried)
+            changes = dict((wsck, change) for wsck, change
+                           in (feed.changes or {}).items()
+                           if change[1] > started)
+            for wsck, (start, _) in changes.items():
+                known.pop(wsck, None)
+                # past the end of an incomplete query we don't know the order
+                if start and (complete or not queried or
+                              [start, wsck] < queried[-1]):
+                    known[wsck] = start
+            items = sorted([start, wsck] for wsck, start in known.items()
+                           if start >= today)
+            feed.changes = changes
+            feed.complete = complete and len(items) <= UPCOMING_SIZE
+            feed.items = items[:UPCOMING_SIZE]
+            feed.put()
+        merge()
+
+
+    @endpoints.method(UPCOMING_GET_REQUEST, ConferenceForms,
+            path='conferences/upcoming',
+            http_method='GET', name='getUpcomingConferences')
+    @instrumented
+    def getUpcomingConferences(self, request):
+        """Return conferences starting within `days` days, soonest first."""
+        days = request.days or UPCOMING_DAYS
+        limit = min(request.limit or SEARCH_PAGE_SIZE, UPCOMING_MAX_LIMIT)
+        feed = ndb.Key(UpcomingConferences, UPCOMING_ID).get()
+        items = feed and feed.items
+        if not feed or (not feed.complete and len(feed.items) < limit):
+            # answer from a query; the feed is rebuilt off the read path
+            items = self._queryUpcoming()[0]
+            self._queueUpcomingRebuild()
+
+        today = date.today()
+        first, last = today.isoformat(), \
+            (today + timedelta(days=days)).isoformat()
+        c_keys = [ndb.Key(urlsafe=wsck) for start, wsck in items
+                  if first <= start <= last][:limit]
+        confs = [c for c in ndb.get_multi(c_keys) if c]
+        profiles = ndb.get_multi([ndb.Key(Profile, c.organizerUserId)
+                                  for c in confs])
+        return ConferenceForms(items=[
+            self._copyConferenceToForm(conf, getattr(prof, 'displayName', ''))
+            for conf, prof in zip(confs, profiles)])
+
+# - - - Conference changes - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(CHANGES_GET_REQUEST, ConferenceChanges,
+            path='conferences/changes',
+            http_method='GET', name='getConferenceChanges')
+    @instrumented
+    def getConferenceChanges(self, request):
+        """Return conferences created, changed or deleted since `since`.
+
+        Without `since`, returns every conference.  Pass the first page's
+        `watermark` as `since` next time; changes from shortly before it
+        are returned again, as commits may land after it is taken.
+        """
+        watermark = datetime.utcnow()
+        q = Conference.query()
+        if request.since:
+            try:
+                since = datetime.strptime(request.since, WATERMARK_FORMAT)
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    'Invalid since: %s' % request.since)
+            since -= CHANGES_SLACK
+            q = q.filter(Conference.updated >= since).order(Conference.updated)
+        try:
+            cursor = Cursor(urlsafe=request.pageToken) \
+                if request.pageToken else None
+        except Exception:
+            raise endpoints.BadRequestException('Invalid pageToken')
+
+        # the tombstone query runs while the page is fetched
+        deleted = ConferenceTombstone.query(
+            ConferenceTombstone.deleted >= since).fetch_async(keys_only=True) \
+            if request.since and not cursor else None
+        confs, next_cursor, more = q.fetch_page(CHANGES_PAGE_SIZE,
+                                                start_cursor=cursor)
+        profiles = ndb.get_multi([ndb.Key(Profile, c.organizerUserId)
+                                  for c in confs])
+        return ConferenceChanges(
+            items=[self._copyConferenceToForm(
+                       conf, getattr(prof, 'displayName', None))
+                   for conf, prof in zip(confs, profiles)],
+            deleted=[k.id() for k in deleted.get_result()] if deleted else [],
+            watermark=watermark.strftime(WATERMARK_FORMAT),
+            nextPageToken=next_cursor.urlsafe() if more else None)
+
+# - - - Conference statistics - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _conferenceCounters(conf):
+        """Return the counters a conference contributes to."""
+        counters = {'conferences': 1, 'seats': conf.maxAttendees or 0}
+        if conf.city:
+            counters['city:' + conf.city] = 1
+        if conf.month:
+            counters['month:%d' % conf.month] = 1
+        for topic in set(conf.topics or []):
+            counters['topic:' + topic] = 1
+        return counters
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _updateConferenceStats(counters, oldCounters=None):
+        """Add counters (less oldCounters) to a random stats shard.
+
+        Joins the caller's transaction when there is one, so counts change
+        atomically with the conference or registration being written.
+        """
+        deltas = dict(counters)
+        for name, value in (oldCounters or {}).items():
+            deltas[name] = deltas.get(name, 0) - value
+        deltas = dict((k, v) for k, v in deltas.items() if v)
+        if not deltas:
+            return
+
+        s_key = ndb.Key(ConferenceStatsShard,
+                        random.randint(1, STATS_SHARDS))
+        shard = s_key.get() or ConferenceStatsShard(key=s_key)
+        counts = shard.counts or {}
+        for name, delta in deltas.items():
+            counts[name] = counts.get(name, 0) + delta
+            if not counts[name]:
+                del counts[name]
+        shard.counts = counts
+        shard.put()
+
+
+    @staticmethod
+    def _rebuildConferenceStats():
+        """Recompute all conference counters from scratch."""
+        counts = {}
+        registrations = 0
+        for conf in Conference.query().iter(batch_size=200):
+            for name, value in \
+                    ConferenceApi._conferenceCounters(conf).items():
+                counts[name] = counts.get(name, 0) + value
+            if conf.maxAttendees:
+                registrations += conf.maxAttendees - (conf.seatsAvailable or 0)
+        if registrations:
+            counts['registrations'] = registrations
+
+        # totals go in the first shard, the rest are emptied; all shards
+        # fit in one xg transaction
+        shards = [ConferenceStatsShard(id=i, counts={})
+                  for i in range(1, STATS_SHARDS + 1)]
+        shards[0].counts = counts
+        ndb.transaction(lambda: ndb.put_multi(shards), xg=True)
+        return counts
+
+
+    @endpoints.method(message_types.VoidMessage, ConferenceStatsForm,
+            path='conference/stats',
+            http_method='GET', name='getConferenceStats')
+    @instrumented
+    def getConferenceStats(self, request):
+        """Return conference counts by city, month and topic, and totals."""
+        counts = {}
+        s_keys = [ndb.Key(ConferenceStatsShard, i)
+                  for i in range(1, STATS_SHARDS + 1)]
+        for shard in ndb.get_multi(s_keys):
+            for name, value in ((shard and shard.counts) or {}).items():
+                counts[name] = counts.get(name, 0) + value
+
+        stats = ConferenceStatsForm(
+            conferences=counts.pop('conferences', 0),
+            seats=counts.pop('seats', 0),
+            registrations=counts.pop('registrations', 0))
+        for name, value in sorted(counts.items()):
+            dimension, _, label = name.partition(':')
+            getattr(stats, {'city': 'cities', 'month': 'months',
+                            'topic': 'topics'}[dimension]).append(
+                StatCount(name=label, count=value))
+        return stats
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
 # added by MKM
@@ -404,8 +1111,12 @@ class ConferenceApi(remote.Service):
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # get conference that session will belong to
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # get conference that session will belong to, allocating
+        # the session's id meanwhile
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = c_key.get_async()
+        s_ids = Session.allocate_ids_async(size=1, parent=c_key)
+        conf = conf.get_result()
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException('No conference found with ' \
@@ -425,6 +1136,7 @@ class ConferenceApi(remote.Service):
                 for field in request.all_fields()}
         del data['websafeConferenceKey']    # conf key isn't part of session
         del data['websafeKey']              # websafe key not part of session
+        del data['conflictsWith']           # computed for wishlist responses
 
         # add default values if missing (both data model & outbound message)
         for df in SESS_DEFAULTS:
@@ -450,17 +1162,19 @@ class ConferenceApi(remote.Service):
                     key_list.append(s_key)
             data['speaker'] = key_list
         
-        # allocate session id
-        s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
+        # use allocated session id
+        s_id = s_ids.get_result()[0]
         s_key = ndb.Key(Session, s_id, parent=conf.key)
         data['key'] = s_key
 
         # create Session
         sess = Session(**data)
-        sess.put()
+        unitofwork.put(sess)
+        self._bumpVersion('sessions_' + conf.key.urlsafe())
+        textsearch.enqueueIndex(sess.key)
         
         # if speaker is ubiquitous, make an announcement, but do it on own time
-        taskqueue.add(
+        unitofwork.addTask(
             params={
                 'websafeConferenceKey': request.websafeConferenceKey,
                 'websafeSessionKey': sess.key.urlsafe()
@@ -473,18 +1187,27 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESS_POST_REQUEST, SessionForm, 
             path='conference/{websafeConferenceKey}/sessions/new',
             http_method='POST', name='createSession')
+    @instrumented
+    @unitOfWork
     def createSession(self, request):
         """Create new session in conference with key {websafeConferenceKey}."""
         return self._createSessionObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_CACHED_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions',
             http_method='GET',
             name='getConferenceSessions')
+    @instrumented
     def getConferenceSessions(self, request):
         """Return sessions in conference (by websafeConferenceKey)."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag = self._resourceVersion('sessions_' + c_key.urlsafe())
+        notModified = self._notModified(request, etag, SessionForms)
+        if notModified:
+            return notModified
+
         # get parent Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException('No conference found with ' \
                         'key: {}'.format(request.websafeConferenceKey))
@@ -493,13 +1216,15 @@ class ConferenceApi(remote.Service):
         sess = Session.query(ancestor=conf.key)
 
         return SessionForms(
-            items=[self._copySessionToForm(s) for s in sess]
+            items=[self._copySessionToForm(s) for s in sess],
+            etag=etag
         )
     
     @endpoints.method(SESS_TYPE_QUERY_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions/query',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Return sessions of given type in conference with given key."""
         # get parent Conference key from request; bail if not found
@@ -521,6 +1246,7 @@ class ConferenceApi(remote.Service):
                       path='session/query/speaker/{websafeSpeakerKey}',
                       http_method='GET',
                       name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """Return all sessions with given speaker across all conferences."""
         # get speaker key from request; bail if not found
@@ -536,39 +1262,106 @@ class ConferenceApi(remote.Service):
             items=[self._copySessionToForm(s) for s in sess]
         )
 
-    @ndb.transactional()
+    def _wishlistSchedule(self, prof, sessions):
+        """Return prof's wishlist interval index, rebuilding it if stale.
+
+        The index is kept up to date as sessions are added; profiles from
+        before it existed (or whose wishlist changed elsewhere) get it
+        rebuilt from the wishlist sessions and saved.
+        """
+        index = prof.wishlistSchedule
+        scheduled = set(s.key.urlsafe() for s in sessions
+                        if s and intervals.sessionInterval(s))
+        if index is not None and intervals.keys(index) == scheduled:
+            return index
+
+        index = intervals.build(sessions)
+        wishlist = list(prof.sessionWishlist)
+
+        @ndb.transactional()
+        def save():
+            # skip if the wishlist changed since sessions were read
+            current = prof.key.get()
+            if current.sessionWishlist == wishlist:
+                current.wishlistSchedule = index
+                current.put()
+        save()
+        return index
+
+
+    def _copyWishlistToForms(self, sessions, conflicts):
+        """Return SessionForms for sessions, marking conflicts given."""
+        forms = []
+        for sess in sessions:
+            if sess:
+                sf = self._copySessionToForm(sess)
+                sf.conflictsWith = conflicts.get(sess.key.urlsafe(), [])
+                forms.append(sf)
+        return SessionForms(items=forms)
+
+
     @endpoints.method(SESS_GET_REQUEST, SessionForms,
                       path='session/wish/new/{websafeSessionKey}',
                       http_method='POST',
                       name='addSessionToWishlist')
+    @instrumented
+    @ratelimited
     def addSessionToWishlist(self, request):
-        """Add session to user's wish list and return updated list."""
+        """Add session to user's wish list and return updated list.
+
+        The added session's conflictsWith lists wishlist sessions it
+        overlaps (and they list it).
+        """
         # get user info
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
-        prof = ndb.Key(Profile, user_id).get()
-        
-        # add session key to wishlist if not already there and commit
+
         s_key = ndb.Key(urlsafe=request.websafeSessionKey)
-        if s_key not in prof.sessionWishlist:
-            prof.sessionWishlist.append(s_key)
-        prof.put()
-        
+        sess = s_key.get()
+        if not sess:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.websafeSessionKey)
+        interval = intervals.sessionInterval(sess)
+
+        # add session key to wishlist if not already there and commit
+        @ndb.transactional()
+        def add():
+            prof = ndb.Key(Profile, user_id).get()
+            if s_key not in prof.sessionWishlist:
+                prof.sessionWishlist.append(s_key)
+                if prof.wishlistSchedule is not None and interval:
+                    intervals.insert(prof.wishlistSchedule, interval)
+                prof.put()
+                # count it towards session recommendations
+                taskqueue.add(params={'userId': user_id,
+                                      'websafeSessionKey': s_key.urlsafe()},
+                              url='/tasks/record_wishlist_add',
+                              transactional=True)
+            return prof
+        prof = add()
+
         # get and return all session in updated wishlist
-        sess = ndb.get_multi(prof.sessionWishlist)
-        
-        return SessionForms(
-            items=[self._copySessionToForm(s) for s in sess]
-        )
-        
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+        sessions = ndb.get_multi(prof.sessionWishlist)
+        conflicts = {}
+        if interval:
+            index = self._wishlistSchedule(prof, sessions)
+            wssk = s_key.urlsafe()
+            conflicts[wssk] = intervals.overlaps(index, interval[0],
+                                                 interval[1], exclude=wssk)
+            for other in conflicts[wssk]:
+                conflicts[other] = [wssk]
+        return self._copyWishlistToForms(sessions, conflicts)
+
+
+    @endpoints.method(WISHLIST_GET_REQUEST, SessionForms,
                       path='wishlist/session',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
-        """Return sessions in users wish list."""
+        """Return sessions in users wish list, optionally with conflicts."""
         # get user info
         user = endpoints.get_current_user()
         if not user:
@@ -577,10 +1370,26 @@ class ConferenceApi(remote.Service):
         prof = ndb.Key(Profile, user_id).get()
         
         # get and return all sessions in updated wishlist
-        sess = ndb.get_multi(prof.sessionWishlist)
-        
+        sessions = ndb.get_multi(prof.sessionWishlist)
+        conflicts = {}
+        if request.conflicts:
+            conflicts = intervals.conflicts(
+                self._wishlistSchedule(prof, sessions))
+        return self._copyWishlistToForms(sessions, conflicts)
+
+    @endpoints.method(SESS_GET_REQUEST, SessionForms,
+                      path='session/{websafeSessionKey}/recommended',
+                      http_method='GET',
+                      name='getRecommendedSessions')
+    @instrumented
+    def getRecommendedSessions(self, request):
+        """Return sessions most often wishlisted along with given one."""
+        rec = ndb.Key(SessionRecommendation, request.websafeSessionKey).get()
+        neighbours = [ndb.Key(urlsafe=wssk)
+                      for wssk in (rec and rec.neighbours) or []]
         return SessionForms(
-            items = [self._copySessionToForm(s) for s in sess]
+            items=[self._copySessionToForm(s)
+                   for s in ndb.get_multi(neighbours) if s]
         )
 
 # - - - Speaker objects - - - - - - - - - - - - - - - - -
@@ -623,28 +1432,121 @@ class ConferenceApi(remote.Service):
         # create Session, send email to organizer confirming
         # creation of Session & return (modified) SessionForm
         speaker = Speaker(**data)
-        speaker.put()
+        unitofwork.put(speaker)
+        self._bumpVersion('speakers')
 
         return self._copySpeakerToForm(speaker)
 
     @endpoints.method(SpeakerForm, SpeakerForm, 
             path='speaker/new',
             http_method='POST', name='createSpeaker')
+    @instrumented
+    @unitOfWork
     def createSpeaker(self, request):
         """Create new speaker entity."""
         return self._createSpeakerObject(request)
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(CACHED_GET_REQUEST, SpeakerForms,
             path='speakers',
             http_method='GET',
             name='getSpeakers')
+    @instrumented
     def getSpeakers(self, request):
         """Return all speakers."""
+        etag = self._resourceVersion('speakers')
+        notModified = self._notModified(request, etag, SpeakerForms)
+        if notModified:
+            return notModified
         return SpeakerForms(
-            items=[self._copySpeakerToForm(s) for s in Speaker.query()]
+            items=[self._copySpeakerToForm(s) for s in Speaker.query()],
+            etag=etag
         )
 
 
+# - - - Batch gets - - - - - - - - - - - - - - - - - - - - - -
+
+    def _batchGet(self, websafeKeys, kind, related=None):
+        """Decode websafe keys of kind and fetch them in one batch.
+
+        related(key) names extra keys to fetch in the same batch.  Returns
+        the decoded keys (None where invalid or of another kind) and a
+        dict of fetched entities.
+        """
+        if len(websafeKeys) > MAX_BATCH_GET_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d keys per request' % MAX_BATCH_GET_KEYS)
+        keys = []
+        for wsk in websafeKeys:
+            try:
+                key = ndb.Key(urlsafe=wsk)
+            except Exception:
+                key = None
+            keys.append(key if key and key.kind() == kind else None)
+
+        fetch = set(k for k in keys if k)
+        if related:
+            fetch.update(r for k in list(fetch) for r in related(k) if r)
+        fetch = list(fetch)
+        # futures issued together go out as one batched datastore RPC
+        futures = ndb.get_multi_async(fetch)
+        return keys, dict((k, f.get_result()) for k, f in zip(fetch, futures))
+
+
+    @endpoints.method(KEYS_GET_REQUEST, ConferenceResults,
+            path='conferences/batch',
+            http_method='GET', name='getConferencesByKeys')
+    @instrumented
+    @ratelimited
+    def getConferencesByKeys(self, request):
+        """Return conferences for a list of websafe keys."""
+        # organizer profiles are the conferences' parents
+        keys, entities = self._batchGet(request.websafeKeys, 'Conference',
+                                        lambda k: [k.parent()])
+        items = []
+        for wsk, key in zip(request.websafeKeys, keys):
+            conf = entities.get(key)
+            result = ConferenceResult(websafeKey=wsk, found=bool(conf))
+            if conf:
+                prof = entities.get(key.parent())
+                result.conference = self._copyConferenceToForm(
+                    conf, getattr(prof, 'displayName', None))
+            items.append(result)
+        return ConferenceResults(items=items)
+
+
+    @endpoints.method(KEYS_GET_REQUEST, SessionResults,
+            path='sessions/batch',
+            http_method='GET', name='getSessionsByKeys')
+    @instrumented
+    def getSessionsByKeys(self, request):
+        """Return sessions for a list of websafe keys."""
+        keys, entities = self._batchGet(request.websafeKeys, 'Session')
+        items = []
+        for wsk, key in zip(request.websafeKeys, keys):
+            sess = entities.get(key)
+            result = SessionResult(websafeKey=wsk, found=bool(sess))
+            if sess:
+                result.session = self._copySessionToForm(sess)
+            items.append(result)
+        return SessionResults(items=items)
+
+
+    @endpoints.method(KEYS_GET_REQUEST, SpeakerResults,
+            path='speakers/batch',
+            http_method='GET', name='getSpeakersByKeys')
+    @instrumented
+    def getSpeakersByKeys(self, request):
+        """Return speakers for a list of websafe keys."""
+        keys, entities = self._batchGet(request.websafeKeys, 'Speaker')
+        items = []
+        for wsk, key in zip(request.websafeKeys, keys):
+            speaker = entities.get(key)
+            result = SpeakerResult(websafeKey=wsk, found=bool(speaker))
+            if speaker:
+                result.speaker = self._copySpeakerToForm(speaker)
+            items.append(result)
+        return SpeakerResults(items=items)
+
 # - - - Queries - - - - - - - - - - - - - - - - - - -
 # added by MKM
 
@@ -652,6 +1554,7 @@ class ConferenceApi(remote.Service):
                       path='session/query/start_times/{websafeConferenceKey}',
                       http_method='GET',
                       name='getSessionsWithStartTimesWithin')
+    @instrumented
     def getSessionsWithStartTimesWithin(self, request):
         """Return all sessions in a conference with start times in window."""
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
@@ -701,6 +1604,7 @@ class ConferenceApi(remote.Service):
                       path='session/query/date_city',
                       http_method='GET',
                       name='getSessionsByDateAndCity')
+    @instrumented
     def getSessionsByDateAndCity(self, request):
         """Return all sessions in given city on given date."""
         # Expect date in format YYYY-MM-DD
@@ -736,6 +1640,7 @@ class ConferenceApi(remote.Service):
                       path='session/query/puzzle',
                       http_method='GET',
                       name='getSessionsBeforeStartTimeNoType')
+    @instrumented
     def getSessionsBeforeStartTimeNoType(self, request):
         """Return all sessions not of given type occurring before startTime."""
         # Expect startTime in format HHMM
@@ -757,6 +1662,62 @@ class ConferenceApi(remote.Service):
             items=[self._copySessionToForm(s) for s in sess]
         )
 
+# - - - Search - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _searchPage(self, kind, request):
+        """Return keys on requested page of search results & next token."""
+        if not request.query:
+            raise endpoints.BadRequestException("Search 'query' required")
+        limit = min(request.limit or SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken')
+
+        hits = textsearch.search(kind, request.query)
+        page = hits[offset:offset + limit]
+        nextPageToken = None
+        if offset + limit < len(hits):
+            nextPageToken = str(offset + limit)
+        return [ndb.Key(urlsafe=k) for k, score in page], nextPageToken
+
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+                      path='search/conferences',
+                      http_method='GET',
+                      name='searchConferences')
+    @instrumented
+    @ratelimited
+    def searchConferences(self, request):
+        """Return conferences matching all query terms (term* = prefix)."""
+        keys, nextPageToken = self._searchPage('Conference', request)
+
+        # organizers' profiles are the conferences' parents; get together
+        entities = ndb.get_multi(keys + [k.parent() for k in keys])
+        confs, profs = entities[:len(keys)], entities[len(keys):]
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(conf,
+                        getattr(prof, 'displayName', None))
+                   for conf, prof in zip(confs, profs) if conf],
+            nextPageToken=nextPageToken
+        )
+
+
+    @endpoints.method(SEARCH_REQUEST, SessionForms,
+                      path='search/sessions',
+                      http_method='GET',
+                      name='searchSessions')
+    @instrumented
+    @ratelimited
+    def searchSessions(self, request):
+        """Return sessions matching all query terms (term* = prefix)."""
+        keys, nextPageToken = self._searchPage('Session', request)
+        return SessionForms(
+            items=[self._copySessionToForm(s) for s in ndb.get_multi(keys)
+                   if s],
+            nextPageToken=nextPageToken
+        )
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
@@ -773,6 +1734,10 @@ class ConferenceApi(remote.Service):
                 elif field.name == 'sessionWishlist':
                     setattr(pf, field.name, 
                             [sk.urlsafe() for sk in prof.sessionWishlist])
+                elif field.name == 'conferenceKeysToAttend':
+                    setattr(pf, field.name,
+                            [ck.urlsafe() for ck in prof.conferencesToAttend]
+                            + prof.conferenceKeysToAttend)
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
@@ -781,6 +1746,12 @@ class ConferenceApi(remote.Service):
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
+        """Tasklet version of _getProfileFromUser, to overlap other reads."""
         # make sure user is authed
         user = endpoints.get_current_user()
         if not user:
@@ -789,7 +1760,7 @@ class ConferenceApi(remote.Service):
         # get Profile from datastore
         user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
+        profile = yield p_key.get_async()
         # create new Profile if not there
         if not profile:
             profile = Profile(
@@ -798,9 +1769,22 @@ class ConferenceApi(remote.Service):
                 mainEmail= user.email(),
                 teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
             )
-            profile.put()
+            unitofwork.put(profile)
+        elif profile.conferenceKeysToAttend:
+            # convert legacy registrations on first read
+            profile = self._migrateProfile(p_key) or profile
+
+        raise ndb.Return(profile)   # return Profile
 
-        return profile      # return Profile
+
+    @staticmethod
+    @ndb.transactional()
+    def _migrateProfile(p_key):
+        """Move a profile's legacy registrations to keys; return it."""
+        prof = p_key.get()
+        if prof and prof.migrateAttending():
+            prof.put()
+        return prof
 
 
     def _doProfile(self, save_request=None):
@@ -809,17 +1793,25 @@ class ConferenceApi(remote.Service):
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
+        changed = renamed = False
         if save_request:
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
                     if val:
+                        # displayName is shown as organizerDisplayName
+                        # on conferences
+                        renamed = renamed or field == 'displayName'
                         setattr(prof, field, str(val))
                         #if field == 'teeShirtSize':
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        changed = True
+        if changed:
+            unitofwork.put(prof)
+        if renamed:
+            self._bumpVersion('profile_%s' % prof.key.id())
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -827,6 +1819,8 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
+    @instrumented
+    @unitOfWork
     def getProfile(self, request):
         """Return user profile."""
         return self._doProfile()
@@ -834,6 +1828,8 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
             path='profile', http_method='POST', name='saveProfile')
+    @instrumented
+    @unitOfWork
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
@@ -841,37 +1837,155 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _isNearlySoldOut(conf):
+        """Return True if conference should be in the announcement."""
+        return 0 < (conf.seatsAvailable or 0) <= NEARLY_SOLD_OUT_SEATS
+
+
+    @staticmethod
+    def _trackNearlySoldOut(conf, wasNearlySoldOut, oldName=None):
+        """Update nearly sold out set if conf crossed the seat threshold.
+
+        Must run inside the (xg) transaction that writes conf, so the set
+        changes atomically with the seat count; memcache is refreshed once
+        the transaction commits.
+        """
+        isNearlySoldOut = ConferenceApi._isNearlySoldOut(conf)
+        renamed = oldName is not None and oldName != conf.name
+        if isNearlySoldOut == wasNearlySoldOut and \
+                not (isNearlySoldOut and renamed):
+            return
+
+        a_key = ndb.Key(Announcement, ANNOUNCEMENT_ID)
+        ann = a_key.get() or Announcement(key=a_key)
+        confs = ann.conferences or {}
+        if isNearlySoldOut:
+            confs[conf.key.urlsafe()] = conf.name
+        else:
+            confs.pop(conf.key.urlsafe(), None)
+        ann.conferences = confs
+        ann.generation += 1
+        ann.put()
+        ndb.get_context().call_on_commit(
+            lambda: ConferenceApi._setAnnouncement(ann))
+
+
+    @staticmethod
+    def _setAnnouncement(ann):
+        """Cache announcement text for given Announcement state.
+
+        Commit callbacks can run out of order, so the cached value carries
+        the state's generation and is only ever replaced (via CAS) by a
+        newer one.
+        """
+        text = ''
+        if ann.conferences:
+            text = ANNOUNCEMENT_TPL % ', '.join(sorted(
+                ann.conferences.values()))
+        value = (ann.generation, text)
+
+        client = memcache.Client()
+        for attempt in range(3):
+            cached = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+            if cached is None:
+                if client.add(MEMCACHE_ANNOUNCEMENTS_KEY, value):
+                    break
+            elif isinstance(cached, tuple) and cached[0] >= ann.generation:
+                return text     # newer (or same) state already cached
+            elif client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, value):
+                break
+        if not isinstance(cached, tuple) or cached[1] != text:
+            ConferenceApi._bumpVersion('announcement')
+        return text
+
+
+    @staticmethod
+    def _getAnnouncement():
+        """Return announcement text, from memcache or the Announcement."""
+        return ConferenceApi._getAnnouncementAsync().get_result()
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _getAnnouncementAsync():
+        cached = yield ndb.get_context().memcache_get(
+            MEMCACHE_ANNOUNCEMENTS_KEY)
+        if isinstance(cached, tuple):
+            raise ndb.Return(cached[1])
+        ann = yield ndb.Key(Announcement, ANNOUNCEMENT_ID).get_async()
+        raise ndb.Return(ConferenceApi._setAnnouncement(ann) if ann else '')
+
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _reconcileNearlySoldOut(c_keys, reconciled=None):
+        """Recheck given conferences against the nearly sold out set."""
+        a_key = ndb.Key(Announcement, ANNOUNCEMENT_ID)
+        ann = a_key.get() or Announcement(key=a_key)
+        confs = dict(ann.conferences or {})
+        for c_key, conf in zip(c_keys, ndb.get_multi(c_keys)):
+            if conf and ConferenceApi._isNearlySoldOut(conf):
+                confs[c_key.urlsafe()] = conf.name
+            else:
+                confs.pop(c_key.urlsafe(), None)
+        changed = confs != (ann.conferences or {})
+        if changed:
+            ann.conferences = confs
+            ann.generation += 1
+        if reconciled:
+            ann.reconciled = reconciled
+        if changed or reconciled:
+            ann.put()
+        return ann
+
+
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Reconcile nearly sold out set & assign announcement to memcache;
+        used by memcache cron job.
+
+        Registrations and updates maintain the set as they commit, so this
+        only rechecks conferences changed since the previous pass (or does
+        one full scan, the first time).
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        ann = ndb.Key(Announcement, ANNOUNCEMENT_ID).get()
+        started = datetime.utcnow()
+        if ann and ann.reconciled:
+            # allow for transactions still in flight at the last pass
+            since = ann.reconciled - RECONCILE_SLACK
+            c_keys = Conference.query(Conference.updated >= since)\
+                               .fetch(keys_only=True)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            c_keys = Conference.query(ndb.AND(
+                Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+                Conference.seatsAvailable > 0)
+            ).fetch(keys_only=True)
+            if ann and ann.conferences:
+                c_keys.extend(ndb.Key(urlsafe=k) for k in ann.conferences)
+
+        # recheck in batches that fit a cross-group transaction
+        c_keys = list(set(c_keys))
+        for i in range(0, len(c_keys), RECONCILE_BATCH_SIZE):
+            ann = ConferenceApi._reconcileNearlySoldOut(
+                c_keys[i:i + RECONCILE_BATCH_SIZE])
+        ann = ConferenceApi._reconcileNearlySoldOut([], reconciled=started)
 
-        return announcement
+        # always rewrite memcache, in case the entry was evicted
+        return ConferenceApi._setAnnouncement(ann)
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(CACHED_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        etag = self._resourceVersion('announcement')
+        notModified = self._notModified(request, etag, StringMessage, data='')
+        if notModified:
+            return notModified
+        return StringMessage(data=self._getAnnouncement(), etag=etag)
 
 
 # - - - Featured Speaker - - - - - - - - - - - - - - - - - - - -
@@ -912,87 +2026,138 @@ class ConferenceApi(remote.Service):
                 else:
                     speaker_keys = set([sp_key])
                 memcache.set(mem_key, speaker_keys)
+                ConferenceApi._bumpVersion('featured_' + conf.key.urlsafe())
 
-    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+    @endpoints.method(CONF_CACHED_GET_REQUEST, StringMessage,
             path='conference/featuredspeaker/{websafeConferenceKey}',
             http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Return featured speaker(s) for given conference from memcache."""
+        etag = self._resourceVersion('featured_' + ndb.Key(
+            urlsafe=request.websafeConferenceKey).urlsafe())
+        notModified = self._notModified(request, etag, StringMessage, data='')
+        if notModified:
+            return notModified
+
+        speakers = self._getFeaturedSpeakerAsync(
+            request.websafeConferenceKey).get_result()
+        return StringMessage(data=speakers, etag=etag)
+
+
+    @staticmethod
+    @ndb.tasklet
+    def _getFeaturedSpeakerAsync(websafeConferenceKey):
+        """Return featured speaker text for a conference from memcache."""
+        ctx = ndb.get_context()
         mem_key = '_'.join((MEMCACHE_FEATURED_SPEAKERS_KEY, 
-                           request.websafeConferenceKey))
-        speaker_keys = memcache.get(mem_key)    # get keys for speakers
-        
-        # if keys exist, get values for each speaker
+                           websafeConferenceKey))
+        speaker_keys = yield ctx.memcache_get(mem_key)  # get keys for speakers
+
+        # if keys exist, get values for each speaker (in one batch)
+        speakers = ''
         if speaker_keys:
+            values = yield [ctx.memcache_get(k) for k in speaker_keys]
             speakers = 'Featured Speaker'
             speakers += 's:' if len(speaker_keys) > 1 else ':'    # fix grammar
-            for speaker_key in speaker_keys:
-                speakers = '\n'.join((speakers, memcache.get(speaker_key)))
-        else:
-            speakers = ''
-            
-        return StringMessage(data=speakers)
+            for value in values:
+                if value:
+                    speakers = '\n'.join((speakers, value))
+        raise ndb.Return(speakers)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
     @ndb.transactional(xg=True)
+    def _repairSeats(c_key, registered, since=None):
+        """Set seatsAvailable from a conference's true registration count.
+
+        Returns the (stored, corrected) seat counts, or None if the
+        conference no longer exists or was updated after `since`.
+        """
+        conf = c_key.get()
+        if not conf or (since and conf.updated and conf.updated > since):
+            return None
+        stored = conf.seatsAvailable or 0
+        seats = max(0, (conf.maxAttendees or 0) - registered)
+        if seats != stored:
+            wasNearlySoldOut = ConferenceApi._isNearlySoldOut(conf)
+            conf.seatsAvailable = seats
+            conf.put()
+            ConferenceApi._trackNearlySoldOut(conf, wasNearlySoldOut)
+            ConferenceApi._updateConferenceStats(
+                {'registrations': stored - seats})
+            ConferenceApi._bumpVersion('conf_' + c_key.urlsafe())
+            if seats > stored:
+                ConferenceApi._queueWaitlistPromotion(c_key.urlsafe())
+        return stored, seats
+
+
+    @ndb.transactional(xg=True, retries=0)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
         retval = None
-        prof = self._getProfileFromUser() # get user Profile
+        # get user Profile and conference together
+        wsck = request.websafeConferenceKey
+        prof = self._getProfileFromUserAsync()
+        conf = ndb.Key(urlsafe=wsck).get_async()
+        prof, conf = prof.get_result(), conf.get_result()
 
         # check if conf exists given websafeConfKey
-        # get conference; check that it exists
-        wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        wasNearlySoldOut = self._isNearlySoldOut(conf)
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.attending():
                 raise ConflictException(
                     "You have already registered for this conference")
 
             # check if seats avail
             if conf.seatsAvailable <= 0:
                 raise ConflictException(
-                    "There are no seats available.")
+                    "There are no seats available; join the waitlist.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            prof.conferencesToAttend.append(conf.key)
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.attending():
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                prof.conferencesToAttend.remove(conf.key)
                 conf.seatsAvailable += 1
                 retval = True
+                self._queueWaitlistPromotion(wsck)
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
+        # write things back to the datastore & return; an unregister that
+        # changed nothing mustn't touch the conference's updated time
+        if retval:
+            ndb.put_multi([prof, conf])
+            self._trackNearlySoldOut(conf, wasNearlySoldOut)
+            self._updateConferenceStats({'registrations': 1 if reg else -1})
+            self._bumpVersion('conf_' + conf.key.urlsafe())
         return BooleanMessage(data=retval)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        conferences = ndb.get_multi(prof.conferencesToAttend)
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
@@ -1009,25 +2174,212 @@ class ConferenceApi(remote.Service):
         )
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    def _retryRegistration(self, request, reg):
+        """Run registration transaction, backing off on contention.
+
+        Retries wait a random time up to an exponentially growing bound
+        ("full jitter"), so clients contending for one conference spread
+        out instead of colliding again in lockstep.
+        """
+        for attempt in range(REGISTRATION_ATTEMPTS):
+            try:
+                return self._conferenceRegistration(request, reg)
+            except datastore_errors.TransactionFailedError:
+                if attempt == REGISTRATION_ATTEMPTS - 1:
+                    rpcstats.incrementCounter('txn_failures')
+                    raise ServiceUnavailableException(
+                        'Conference is busy, please try again.')
+                rpcstats.incrementCounter('txn_retries')
+                bound = REGISTRATION_BACKOFF * 2 ** attempt
+                sleep(random.uniform(0, min(REGISTRATION_BACKOFF_CAP, bound)))
+
+
+    def _idempotentRegistration(self, request, reg=True):
+        """(Un)register, answering repeats of a requestId from memcache.
+
+        A retried request carrying the same requestId gets the outcome of
+        the first one (its result or ConflictException) without running
+        the transaction again.
+        """
+        if not request.requestId:
+            return self._retryRegistration(request, reg)
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        key = MEMCACHE_REGISTRATION_TPL % (
+            getUserId(user), 'reg' if reg else 'unreg',
+            request.websafeConferenceKey, request.requestId)
+
+        # claim the requestId; a duplicate sees the claim or the outcome
+        if not memcache.add(key, ('pending',), time=REGISTRATION_PENDING_TTL):
+            outcome = memcache.get(key)
+            if outcome is None:
+                # memcache is down (or the claim just expired): run
+                # without dedup; the transaction rejects a double
+                # registration anyway
+                return self._retryRegistration(request, reg)
+            if outcome[0] == 'pending':
+                raise ServiceUnavailableException(
+                    'Request %s is in progress.' % request.requestId)
+            rpcstats.incrementCounter('dedup_hits')
+            if outcome[0] == 'conflict':
+                raise ConflictException(outcome[1])
+            return BooleanMessage(data=outcome[1])
+
+        try:
+            result = self._retryRegistration(request, reg)
+        except ConflictException as e:
+            memcache.set(key, ('conflict', str(e)),
+                         time=REGISTRATION_RESULT_TTL)
+            raise
+        except Exception:
+            memcache.delete(key)    # nothing happened; let a retry run
+            raise
+        memcache.set(key, ('done', result.data), time=REGISTRATION_RESULT_TTL)
+        return result
+
+
+    @endpoints.method(CONF_REGISTRATION_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @instrumented
+    @ratelimited
     def registerForConference(self, request):
         """Register user for selected conference."""
-        return self._conferenceRegistration(request)
+        return self._idempotentRegistration(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_REGISTRATION_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='DELETE', name='unregisterFromConference')
+    @instrumented
+    @ratelimited
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
-        return self._conferenceRegistration(request, reg=False)
+        return self._idempotentRegistration(request, reg=False)
+
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _waitlistKey(wsck, user_id):
+        return ndb.Key(WaitlistEntry, '%s:%s' % (wsck, user_id))
+
+
+    @staticmethod
+    def _queueWaitlistPromotion(wsck):
+        """Queue promotion of waitlisted users once current write commits."""
+        taskqueue.add(params={'websafeConferenceKey': wsck},
+                      url='/tasks/promote_waitlist',
+                      transactional=ndb.in_transaction())
+
+
+    def _copyWaitlistEntryToForm(self, entry):
+        """Return WaitlistForm with entry's current position."""
+        ahead = WaitlistEntry.query(
+            WaitlistEntry.conference == entry.conference,
+            WaitlistEntry.joined < entry.joined).count()
+        return WaitlistForm(websafeConferenceKey=entry.conference,
+                            position=ahead + 1, joined=str(entry.joined))
+
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='POST', name='joinWaitlist')
+    @instrumented
+    @ratelimited
+    def joinWaitlist(self, request):
+        """Join waitlist of a sold out conference; return position."""
+        prof = self._getProfileFromUser()
+        wsck = request.websafeConferenceKey
+        w_key = self._waitlistKey(wsck, prof.key.id())
+        conf, entry = ndb.get_multi([ndb.Key(urlsafe=wsck), w_key])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if conf.key in prof.attending():
+            raise ConflictException(
+                "You have already registered for this conference")
+
+        # a plain put: waiting users never touch the conference entity
+        if not entry:
+            if conf.seatsAvailable > 0:
+                raise ConflictException(
+                    "There are seats available; register instead.")
+            entry = WaitlistEntry(key=w_key, conference=wsck,
+                                  userId=prof.key.id())
+            entry.put()
+        return self._copyWaitlistEntryToForm(entry)
+
+
+    @endpoints.method(CONF_GET_REQUEST, WaitlistForm,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='GET', name='getWaitlistPosition')
+    @instrumented
+    def getWaitlistPosition(self, request):
+        """Return user's position on a conference's waitlist."""
+        prof = self._getProfileFromUser()
+        entry = self._waitlistKey(request.websafeConferenceKey,
+                                  prof.key.id()).get()
+        if not entry:
+            raise endpoints.NotFoundException(
+                'You are not on the waitlist for this conference')
+        return self._copyWaitlistEntryToForm(entry)
+
+
+    @staticmethod
+    def _promoteWaitlist(wsck):
+        """Register the longest waiting users for free seats, in one batch.
+
+        Queues another batch while seats and waiting users remain.
+        """
+        c_key = ndb.Key(urlsafe=wsck)
+        conf = c_key.get()
+        if not conf or conf.seatsAvailable <= 0:
+            return
+        limit = min(conf.seatsAvailable, WAITLIST_BATCH_SIZE)
+        entries = WaitlistEntry.query(WaitlistEntry.conference == wsck) \
+            .order(WaitlistEntry.joined) \
+            .fetch(limit)
+        if not entries:
+            return
+
+        @ndb.transactional(xg=True)
+        def promote():
+            conf = c_key.get()
+            wasNearlySoldOut = ConferenceApi._isNearlySoldOut(conf)
+            profiles = ndb.get_multi([ndb.Key(Profile, e.userId)
+                                      for e in entries])
+            promoted, done = [], []
+            for entry, prof in zip(entries, profiles):
+                if conf.seatsAvailable <= 0:
+                    break
+                if prof:
+                    prof.migrateAttending()
+                if prof and conf.key not in prof.attending():
+                    prof.conferencesToAttend.append(conf.key)
+                    conf.seatsAvailable -= 1
+                    promoted.append(prof)
+                done.append(entry.key)
+            ndb.delete_multi(done)
+            if promoted:
+                ndb.put_multi(promoted + [conf])
+                ConferenceApi._trackNearlySoldOut(conf, wasNearlySoldOut)
+                ConferenceApi._updateConferenceStats(
+                    {'registrations': len(promoted)})
+                ConferenceApi._bumpVersion('conf_' + wsck)
+            return conf.seatsAvailable
+        seatsLeft = promote()
+
+        # a full fetch may have left users waiting; skipped entries (no
+        # profile, already attending) can leave seats free
+        if seatsLeft > 0 and len(entries) == limit:
+            ConferenceApi._queueWaitlistPromotion(wsck)
 
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Session.query()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+
+"""
+errors.py -- endpoints exceptions for HTTP statuses endpoints lacks
+
+Kept out of models.py so that task handlers using only the datastore
+models don't import the endpoints library.
+
+"""
+
+import httplib
+
+import endpoints
+
+
+class ConflictException(endpoints.ServiceException):
+    """ConflictException -- exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
+
+class ServiceUnavailableException(endpoints.ServiceException):
+    """ServiceUnavailableException -- exception mapped to HTTP 503 response"""
+    http_status = httplib.SERVICE_UNAVAILABLE
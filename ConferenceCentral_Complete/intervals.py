@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+intervals.py -- sorted interval index for spotting schedule conflicts
+
+An index is a JSON-able dict holding [start, end, websafeKey] intervals
+(minutes since 0001-01-01) sorted by start, plus the longest interval
+length.  Every interval overlapping [start, end) starts within
+maxDuration before `end`, so overlaps() bisects to that window and only
+scans the intervals inside it instead of comparing against every one.
+
+"""
+
+import bisect
+
+DEFAULT_DURATION = 30   # minutes, for sessions without a duration
+
+
+def sessionInterval(sess):
+    """Return [start, end, websafeKey] of a session, or None if unscheduled."""
+    if not (sess.date and sess.startTime):
+        return None
+    start = (sess.date.toordinal() * 24 * 60 +
+             sess.startTime.hour * 60 + sess.startTime.minute)
+    return [start, start + (sess.duration or DEFAULT_DURATION),
+            sess.key.urlsafe()]
+
+
+def build(sessions):
+    """Return a new index of the scheduled sessions given."""
+    index = {'intervals': [], 'maxDuration': 0}
+    for sess in sessions:
+        interval = sess and sessionInterval(sess)
+        if interval:
+            insert(index, interval)
+    return index
+
+
+def insert(index, interval):
+    """Add an interval, keeping the index sorted."""
+    bisect.insort(index['intervals'], interval)
+    index['maxDuration'] = max(index['maxDuration'],
+                               interval[1] - interval[0])
+
+
+def keys(index):
+    return set(i[2] for i in index['intervals'])
+
+
+def overlaps(index, start, end, exclude=None):
+    """Return websafe keys of intervals overlapping [start, end)."""
+    intervals = index['intervals']
+    lo = bisect.bisect_left(intervals, [start - index['maxDuration']])
+    hi = bisect.bisect_left(intervals, [end])
+    return [k for s, e, k in intervals[lo:hi] if e > start and k != exclude]
+
+
+def conflicts(index):
+    """Return {websafeKey: [overlapping websafeKeys]} for the index."""
+    found = {}
+    for start, end, key in index['intervals']:
+        others = overlaps(index, start, end, exclude=key)
+        if others:
+            found[key] = others
+    return found
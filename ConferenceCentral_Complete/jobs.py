@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+"""
+jobs.py -- cursor-chained, sharded batch jobs over an ndb kind
+
+start() splits a kind's key space into ranges using the __scatter__
+property and runs one chain of /tasks/run_job tasks per range.  Each task
+fetches one keys-only batch from its shard's cursor, hands it to the job's
+Mapper, then checkpoints the cursor and enqueues the next task in a single
+transaction.  Tasks carry the shard's sequence number, so a duplicated task
+or one whose batch was already checkpointed does nothing, and a failed
+batch is retried from the last checkpoint -- map_batch() must therefore be
+idempotent.  After MAX_BATCH_RETRIES the job is marked failed; resume()
+restarts its unfinished shards from their checkpoints.
+
+Mappers that aggregate across entities set `buckets` and emit() one dict
+per bucket from each batch, stored as MapperPartials keyed by shard, batch
+number and bucket so a retried batch overwrites its own output.  Once
+every shard is done, one task per bucket passes that bucket's partials to
+Mapper.reduce(), then writes a MapperReduce marker so later copies of the
+task skip it.  The marker isn't written with the reduce's own writes, so a
+crash in between reduces the bucket again: reduce() must be idempotent.
+Finally Mapper.finalize() runs once, in its own task.
+
+"""
+
+import importlib
+import logging
+import traceback
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import MapperJob, MapperShard, MapperPartial, MapperReduce
+
+DEFAULT_SHARDS = 4
+MAX_SHARDS = 32
+SCATTER_OVERSAMPLE = 32     # scatter keys sampled per shard for splits
+MAX_BATCH_RETRIES = 5
+JOB_TASK_URL = '/tasks/run_job'
+GET_BATCH_SIZE = 500
+
+
+class Mapper(object):
+    """Base class for jobs: set kind and override map() or map_batch().
+
+    Counter dicts returned by map_batch() are summed per shard and passed
+    to finalize(), whose return value is stored as the job's result.
+    While a batch runs, self.shard is its MapperShard; shard.batches (the
+    number of batches checkpointed before it) identifies the batch across
+    retries.  Set
+    transactional for kinds users also write: changed entities are then
+    re-read and updated in one transaction each.
+    """
+    kind = None
+    batch_size = 100
+    transactional = False
+    buckets = 0             # > 0 to emit() partials and reduce() them
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    @classmethod
+    def prepare(cls, params):
+        """Return the params to store on a new job of this mapper."""
+        return params
+
+    def map(self, entity):
+        """Update entity in place; return True if it should be put."""
+        raise NotImplementedError
+
+    def map_batch(self, keys):
+        """Process one batch of keys; return counter deltas or None."""
+        entities = [e for e in ndb.get_multi(keys) if e]
+        changed = [e for e in entities if self.map(e)]
+        if changed and self.transactional:
+            futures = [self._mapInTransaction(e.key) for e in changed]
+            ndb.Future.wait_all(futures)
+            for f in futures:
+                f.check_success()
+        elif changed:
+            ndb.put_multi(changed)
+        return {'mapped': len(entities), 'changed': len(changed)}
+
+    @ndb.transactional_tasklet
+    def _mapInTransaction(self, key):
+        entity = yield key.get_async()
+        if entity and self.map(entity):
+            yield entity.put_async()
+
+    def emit(self, buckets):
+        """Store this batch's output: one dict (or None) per bucket."""
+        p_keys = [_partialKey(self.shard.key.id(), self.shard.batches, b)
+                  for b in range(self.buckets)]
+        ndb.put_multi([MapperPartial(key=k, counts=counts)
+                       for k, counts in zip(p_keys, buckets) if counts])
+        # a retry may see different entities; drop what it didn't emit
+        ndb.delete_multi([k for k, counts in zip(p_keys, buckets)
+                          if not counts])
+
+    def reduce(self, job, bucket, partials):
+        """Combine an iterator over a bucket's emitted dicts.
+
+        May run more than once for a bucket, so must be idempotent.
+        """
+        raise NotImplementedError
+
+    def finalize(self, job, counters):
+        """Run once after all shards (and buckets) are done."""
+        return counters
+
+    def report(self, job):
+        """Return extra JSON-able detail for the job's status, if any."""
+        return None
+
+
+def _mapperClass(path):
+    """Return the Mapper subclass named by a 'module.Class' path."""
+    module, _, name = path.rpartition('.')
+    try:
+        cls = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError, ValueError):
+        cls = None
+    if not (isinstance(cls, type) and issubclass(cls, Mapper) and cls.kind):
+        raise ValueError('Not a Mapper: %s' % path)
+    return cls
+
+
+def splitKeys(kind, shards):
+    """Return up to shards-1 sorted keys splitting kind's key space."""
+    if shards < 2:
+        return []
+    # __scatter__ is set on a random ~0.8% of entities; ordering by it
+    # gives a uniform sample of the keys
+    q = ndb.Query(kind=kind).order(ndb.GenericProperty('__scatter__'))
+    sample = sorted(q.fetch(shards * SCATTER_OVERSAMPLE, keys_only=True))
+    step = len(sample) / float(shards)
+    return sorted(set(sample[int(step * i)] for i in range(1, shards)
+                      if int(step * i) < len(sample)))
+
+
+def _partialKey(shardId, batch, bucket):
+    return ndb.Key(MapperPartial, '%s:%d:%d' % (shardId, batch, bucket))
+
+
+def _reduceKey(job_key, bucket):
+    return ndb.Key(MapperReduce, '%d:%d' % (job_key.id(), bucket))
+
+
+def _shardKey(job_key, index):
+    # shards are root entities so their checkpoints don't contend
+    return ndb.Key(MapperShard, '%d:%d' % (job_key.id(), index))
+
+
+def _task(shard):
+    return taskqueue.Task(url=JOB_TASK_URL, params={
+        'job': shard.job.id(), 'shard': shard.key.id(), 'seq': shard.seq})
+
+
+def start(mapper, params=None, shards=DEFAULT_SHARDS):
+    """Start a job running mapper ('module.Class'); return the job id."""
+    cls = _mapperClass(mapper)
+    splits = splitKeys(cls.kind, max(1, min(shards, MAX_SHARDS)))
+    bounds = [None] + splits + [None]
+
+    job = MapperJob(mapper=mapper, params=cls.prepare(dict(params or {})),
+                    shards=len(bounds) - 1, status='running')
+    job.put()
+    shardEntities = [MapperShard(key=_shardKey(job.key, i), job=job.key,
+                                 startKey=bounds[i], endKey=bounds[i + 1])
+                     for i in range(len(bounds) - 1)]
+    ndb.put_multi(shardEntities)
+    # if this fails part way, resume() enqueues the missing chains
+    taskqueue.Queue().add([_task(s) for s in shardEntities])
+    return job.key.id()
+
+
+def getShards(job):
+    """Return the MapperShards of a job, in order."""
+    return ndb.get_multi([_shardKey(job.key, i) for i in range(job.shards)])
+
+
+def resume(jobId):
+    """Restart unfinished shards of a job from their last checkpoints."""
+    job_key = ndb.Key(MapperJob, jobId)
+    job = job_key.get()
+    if not job or job.status == 'done':
+        return False
+    if job.status == 'reducing':
+        _queueReduces(job)
+        return True
+    job.status = 'running'
+    job.put()
+
+    pending = [s for s in getShards(job) if not s.done]
+    for shard in pending:
+        # a new seq retires any task of the old chain still in the queue
+        shard.seq += 1
+        shard.error = None
+    ndb.put_multi(pending)
+    if pending:
+        taskqueue.Queue().add([_task(s) for s in pending])
+    else:
+        _maybeFinish(job_key)
+    return True
+
+
+@ndb.transactional
+def _checkpoint(shard_key, seq, cursor, done, processed, counters):
+    """Record a processed batch and chain the next task, exactly once."""
+    shard = shard_key.get()
+    if shard.seq != seq:
+        return False    # a duplicate task got here first
+    shard.seq += 1
+    shard.cursor = cursor.urlsafe() if cursor else None
+    shard.done = done
+    shard.processed += processed
+    shard.batches += 1
+    totals = shard.counters or {}
+    for name, value in (counters or {}).items():
+        totals[name] = totals.get(name, 0) + value
+    shard.counters = totals
+    shard.put()
+    if not done:
+        taskqueue.add(url=JOB_TASK_URL, transactional=True, params={
+            'job': shard.job.id(), 'shard': shard.key.id(), 'seq': shard.seq})
+    return True
+
+
+def runBatch(jobId, shardId, seq, retries=0):
+    """Process the next batch of a shard (the /tasks/run_job handler)."""
+    job_key = ndb.Key(MapperJob, jobId)
+    job, shard = ndb.get_multi([job_key, ndb.Key(MapperShard, shardId)])
+    if not job or not shard or job.status != 'running' or shard.done \
+            or shard.seq != seq:
+        logging.info('jobs: ignoring stale task %s@%d', shardId, seq)
+        return
+
+    mapper = _mapperClass(job.mapper)(job.params)
+    mapper.shard = shard
+    q = ndb.Query(kind=mapper.kind)
+    if shard.startKey:
+        q = q.filter(ndb.Model.key >= shard.startKey)
+    if shard.endKey:
+        q = q.filter(ndb.Model.key < shard.endKey)
+    keys, cursor, more = q.order(ndb.Model.key).fetch_page(
+        mapper.batch_size, keys_only=True,
+        start_cursor=Cursor(urlsafe=shard.cursor) if shard.cursor else None)
+
+    try:
+        counters = mapper.map_batch(keys) if keys else None
+    except Exception:
+        if retries < MAX_BATCH_RETRIES:
+            raise       # task queue retries from the same checkpoint
+        _fail(job_key, shard.key, seq, traceback.format_exc())
+        return
+
+    done = not (more and cursor)
+    if _checkpoint(shard.key, seq, cursor, done, len(keys), counters) \
+            and done:
+        _maybeFinish(job_key)
+
+
+def _fail(job_key, shard_key, seq, error):
+    logging.error('jobs: shard %s failed at batch %d\n%s',
+                  shard_key.id(), seq, error)
+    shard = shard_key.get()
+    shard.error = error
+    shard.put()
+    job = job_key.get()
+    if job.status == 'running':
+        job.status = 'failed'
+        job.put()
+
+
+def _maybeFinish(job_key):
+    """Queue reduce or finalize once every shard of the job is done."""
+    job = job_key.get()
+    if not all(s and s.done for s in getShards(job)):
+        return
+    reducing = _mapperClass(job.mapper).buckets > 0
+
+    @ndb.transactional
+    def finish():
+        job = job_key.get()
+        if job.status != 'running':
+            return
+        job.status = 'reducing' if reducing else 'finalizing'
+        job.put()
+        # transactions can only add 5 tasks; one fans out the reduces
+        taskqueue.add(url=JOB_TASK_URL, transactional=True, params={
+            'job': job_key.id(), 'reduce' if reducing else 'finalize': 1})
+    finish()
+
+
+def _queueReduces(job):
+    buckets = _mapperClass(job.mapper).buckets
+    taskqueue.Queue().add([
+        taskqueue.Task(url=JOB_TASK_URL,
+                       params={'job': job.key.id(), 'bucket': b})
+        for b in range(buckets)])
+
+
+def startReduce(jobId):
+    """Queue one reduce task per bucket (task handler)."""
+    job = ndb.Key(MapperJob, jobId).get()
+    if job and job.status == 'reducing':
+        _queueReduces(job)
+
+
+def _partialKeys(job, bucket):
+    return [_partialKey(shard.key.id(), n, bucket)
+            for shard in getShards(job) for n in range(shard.batches)]
+
+
+def _partials(job, bucket):
+    """Yield the dicts emitted for a bucket, by every batch of the job."""
+    p_keys = _partialKeys(job, bucket)
+    for i in range(0, len(p_keys), GET_BATCH_SIZE):
+        for partial in ndb.get_multi(p_keys[i:i + GET_BATCH_SIZE],
+                                     use_cache=False):
+            if partial:
+                yield partial.counts
+
+
+def reduceBucket(jobId, bucket):
+    """Run Mapper.reduce() for one bucket (task handler)."""
+    job = ndb.Key(MapperJob, jobId).get()
+    if not job or job.status != 'reducing':
+        return
+    r_key = _reduceKey(job.key, bucket)
+    if r_key.get():
+        return      # already reduced; its partials may be gone
+    mapper = _mapperClass(job.mapper)(job.params)
+    mapper.reduce(job, bucket, _partials(job, bucket))
+    MapperReduce(key=r_key).put()
+
+    p_keys = _partialKeys(job, bucket)
+    for i in range(0, len(p_keys), GET_BATCH_SIZE):
+        ndb.delete_multi(p_keys[i:i + GET_BATCH_SIZE])
+
+    reduced = ndb.get_multi([_reduceKey(job.key, b)
+                             for b in range(mapper.buckets)])
+    if not all(reduced):
+        return
+
+    @ndb.transactional
+    def finish():
+        job = ndb.Key(MapperJob, jobId).get()
+        if job.status != 'reducing':
+            return
+        job.status = 'finalizing'
+        job.put()
+        taskqueue.add(url=JOB_TASK_URL, transactional=True,
+                      params={'job': jobId, 'finalize': 1})
+    finish()
+
+
+def finalizeJob(jobId):
+    """Sum shard counters and run Mapper.finalize() (task handler)."""
+    job = ndb.Key(MapperJob, jobId).get()
+    if not job or job.status != 'finalizing':
+        return
+    counters = {}
+    for shard in getShards(job):
+        for name, value in (shard.counters or {}).items():
+            counters[name] = counters.get(name, 0) + value
+    job.result = _mapperClass(job.mapper)(job.params).finalize(job, counters)
+    job.status = 'done'
+    job.finished = datetime.utcnow()
+    job.put()
+
+
+def status(jobId):
+    """Return a JSON-able progress report for a job, or None."""
+    job = ndb.Key(MapperJob, jobId).get()
+    if not job:
+        return None
+    shards = getShards(job)
+    return {
+        'id': job.key.id(),
+        'mapper': job.mapper,
+        'params': job.params,
+        'status': job.status,
+        'created': job.created.isoformat(),
+        'finished': job.finished and job.finished.isoformat(),
+        'processed': sum(s.processed for s in shards if s),
+        'reduced': sum(1 for r in ndb.get_multi(
+            [_reduceKey(job.key, b) for b in range(
+                _mapperClass(job.mapper).buckets)]) if r),
+        'shards': [{'id': s.key.id(), 'processed': s.processed,
+                    'done': s.done,
+                    'counters': s.counters, 'error': s.error,
+                    'updated': s.updated.isoformat()}
+                   for s in shards if s],
+        'result': job.result,
+        'report': _mapperClass(job.mapper)(job.params).report(job),
+    }
+
+
+def recentJobs(limit=20):
+    """Return status of the most recently started jobs."""
+    keys = MapperJob.query().order(-MapperJob.created).fetch(
+        limit, keys_only=True)
+    return [status(k.id()) for k in keys]
+
+
+# - - - Mappers - - - - - - - - - - - - - - - - - - - - - - - -
+
+class ConferenceMonthMapper(Mapper):
+    """Recompute Conference.month from startDate."""
+    kind = 'Conference'
+    transactional = True    # don't clobber concurrent registrations
+
+    def map(self, conf):
+        month = conf.startDate.month if conf.startDate else 0
+        if conf.month == month:
+            return False
+        conf.month = month
+        return True
+
+    def finalize(self, job, counters):
+        # month feeds the stats counters and facet table
+        if counters.get('changed'):
+            from conference import ConferenceApi
+            ConferenceApi._rebuildConferenceStats()
+            ConferenceApi._invalidateFacetTable()
+        return counters
+
+
+class AttendingKeysMapper(Mapper):
+    """Backfill Profile.conferencesToAttend from legacy websafe keys."""
+    kind = 'Profile'
+    transactional = True    # don't clobber concurrent registrations
+
+    def map(self, prof):
+        return prof.migrateAttending()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+loadgen.py -- mixed-workload load generator for the Conference Central API
+    running on a local dev_appserver
+
+Replays a weighted mix of the calls the web client makes through
+gapi.client.conference.* (browsing conferences and sessions, queries,
+registration, wishlist adds, session creation) at a target request rate,
+from concurrent worker threads acting as simulated users, and reports
+throughput, latency percentiles and conflict, contention, throttling and
+error rates per method as JSON.
+
+Requests are scheduled open-loop at --rate per second; `lag` is how late
+workers started them, and latency is measured from the scheduled start, so
+a saturated server shows up as rising latency rather than a lower rate.
+
+Signed-in calls need real OAuth2 access tokens (dev_appserver checks them
+against Google's tokeninfo endpoint), one per simulated user, one per line
+in --tokens; `gcloud auth print-access-token` prints one for an account.
+Without tokens only the calls that need no user (browse, query) run.
+Conferences and sessions already in the datastore are used; with tokens,
+--conferences more are created first (by the first user, who also creates
+all sessions).
+
+usage:
+    dev_appserver.py . &
+    python loadgen.py --rate 50 --duration 60 --workers 16 \\
+        --tokens tokens.txt --mix browse=40,query=25,register=15,wishlist=15,session=5
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+
+try:
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+except ImportError:     # python 2
+    from urllib2 import HTTPError, Request, URLError, urlopen
+    from urllib import urlencode
+
+API_PATH = '/_ah/api/conference/v1/'
+DEFAULT_MIX = 'browse=40,query=25,register=15,wishlist=15,session=5'
+CITIES = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin', 'Sydney']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SIGNED_IN = ('register', 'wishlist', 'session')
+# ratelimit.py rejects with a 503 whose message starts with this; reported
+# as its own status to tell it from transaction contention
+THROTTLED = 'Throttled'
+
+# - - - HTTP client - - - - - - - - - - - - - - - - - - - - - -
+
+class Client(object):
+    """Calls API methods as one simulated user."""
+
+    def __init__(self, base, token=None, timeout=30):
+        self.base = base.rstrip('/') + API_PATH
+        self.token = token
+        self.timeout = timeout
+
+    def call(self, httpMethod, path, body=None, params=None):
+        """Return (HTTP status or 'throttled', decoded JSON body or None)."""
+        url = self.base + path
+        if params:
+            url += '?' + urlencode(params, doseq=True)
+        if body is None and httpMethod != 'GET':
+            body = {}
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        req = Request(url, data=data)
+        req.get_method = lambda: httpMethod
+        req.add_header('Content-Type', 'application/json')
+        if self.token:
+            req.add_header('Authorization', 'Bearer ' + self.token)
+        try:
+            resp = urlopen(req, timeout=self.timeout)
+            status, content = resp.getcode(), resp.read()
+        except HTTPError as e:
+            status, content = e.code, e.read()
+        except (URLError, IOError):
+            return None, None
+        try:
+            content = json.loads(content.decode('utf-8'))
+        except ValueError:
+            return status, None
+        error = content.get('error') if isinstance(content, dict) else None
+        if status == 503 and isinstance(error, dict) and \
+                str(error.get('message', '')).startswith(THROTTLED):
+            status = 'throttled'
+        return status, content
+
+
+# - - - Workload - - - - - - - - - - - - - - - - - - - - - - -
+
+class Workload(object):
+    """Conferences and sessions to act on, and the operations in the mix."""
+
+    def __init__(self, clients, rand):
+        self.clients = clients
+        self.rand = rand
+        self.conferences = []
+        self.sessions = []
+        self.registered = collections.defaultdict(set)  # user -> conferences
+        self.lock = threading.Lock()
+
+    def setUp(self, create, sessionsPerConference):
+        organizer = self.clients[0]
+        if organizer.token:
+            start = date.today() + timedelta(days=30)
+            for i in range(create):
+                status, conf = organizer.call('POST', 'conference', {
+                    'name': 'Load conference %s' % uuid.uuid4().hex[:8],
+                    'city': self.rand.choice(CITIES),
+                    'topics': self.rand.sample(TOPICS, 2),
+                    'startDate': str(start + timedelta(days=i)),
+                    'endDate': str(start + timedelta(days=i + 2)),
+                    'maxAttendees': len(self.clients),
+                })
+                if status != 200:
+                    raise SystemExit('createConference failed: %s' % status)
+                for j in range(sessionsPerConference):
+                    self.createSession(organizer, conf['websafeKey'], j)
+
+        status, found = organizer.call('POST', 'queryConferences',
+                                       {'filters': []})
+        if status != 200:
+            raise SystemExit('queryConferences failed: %s' % status)
+        self.conferences = [c['websafeKey']
+                            for c in found.get('items', [])]
+        for wsck in self.conferences:
+            status, found = organizer.call(
+                'GET', 'conference/%s/sessions' % wsck)
+            if status == 200:
+                self.sessions.extend(s['websafeKey']
+                                     for s in found.get('items', []))
+        if not self.conferences:
+            raise SystemExit('no conferences to load; pass --tokens so '
+                             'some can be created')
+
+    def createSession(self, client, wsck, i):
+        hour = 8 + i % 10
+        return client.call('POST', 'conference/%s/sessions/new' % wsck, {
+            'name': 'Load session %s' % uuid.uuid4().hex[:8],
+            'duration': self.rand.choice([30, 45, 60]),
+            'typeOfSession': ['lecture'],
+            'startTime': '%02d:%02d' % (hour, self.rand.choice([0, 30])),
+        })
+
+    # each operation returns (method name, HTTP status)
+    def browse(self, user, rand):
+        wsck = rand.choice(self.conferences)
+        if rand.random() < 0.5:
+            return 'getConference', self.clients[user].call(
+                'GET', 'conference/%s' % wsck)[0]
+        return 'getConferenceSessions', self.clients[user].call(
+            'GET', 'conference/%s/sessions' % wsck)[0]
+
+    def query(self, user, rand):
+        field, value = rand.choice([('CITY', rand.choice(CITIES)),
+                                    ('TOPIC', rand.choice(TOPICS))])
+        return 'queryConferences', self.clients[user].call(
+            'POST', 'queryConferences', {'filters': [
+                {'field': field, 'operator': 'EQ', 'value': value}]})[0]
+
+    def register(self, user, rand):
+        """Register for a random conference, or leave one already joined."""
+        wsck = rand.choice(self.conferences)
+        with self.lock:
+            joined = wsck in self.registered[user]
+        name, httpMethod = ('unregisterFromConference', 'DELETE') if joined \
+            else ('registerForConference', 'POST')
+        status = self.clients[user].call(
+            httpMethod, 'conference/%s' % wsck,
+            params={'requestId': uuid.uuid4().hex})[0]
+        if status == 200:
+            with self.lock:
+                if joined:
+                    self.registered[user].discard(wsck)
+                else:
+                    self.registered[user].add(wsck)
+        return name, status
+
+    def wishlist(self, user, rand):
+        if not self.sessions:
+            return self.browse(user, rand)
+        return 'addSessionToWishlist', self.clients[user].call(
+            'POST', 'session/wish/new/%s' % rand.choice(self.sessions))[0]
+
+    def session(self, user, rand):
+        # only the organizer may add sessions to their conferences
+        return 'createSession', self.createSession(
+            self.clients[0], rand.choice(self.conferences),
+            rand.randint(0, 9))[0]
+
+
+def parseMix(spec, signedIn):
+    """Return [(operation, cumulative weight)] from 'op=weight,...'."""
+    mix, total = [], 0
+    for part in spec.split(','):
+        op, weight = part.split('=')
+        if op not in ('browse', 'query') + SIGNED_IN:
+            raise SystemExit('unknown operation in --mix: %s' % op)
+        if op in SIGNED_IN and not signedIn:
+            print('loadgen: no --tokens; skipping %s' % op, file=sys.stderr)
+            continue
+        total += float(weight)
+        mix.append((op, total))
+    if not total:
+        raise SystemExit('nothing to run in --mix')
+    return [(op, w / total) for op, w in mix]
+
+
+# - - - Runner - - - - - - - - - - - - - - - - - - - - - - - -
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    i = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return round(values[i], 1)
+
+
+class LoadGenerator(object):
+    """Open-loop scheduler feeding the workload to worker threads."""
+
+    def __init__(self, workload, mix, rate, duration, workers, seed):
+        self.workload = workload
+        self.mix = mix
+        self.rate = float(rate)
+        self.total = int(rate * duration)
+        self.workers = workers
+        self.seed = seed
+        self.next = 0
+        self.lock = threading.Lock()
+        self.results = collections.defaultdict(list)  # method -> samples
+
+    def pick(self, rand):
+        r = rand.random()
+        for op, bound in self.mix:
+            if r < bound:
+                return op
+        return self.mix[-1][0]
+
+    def worker(self, n, start):
+        rand = random.Random(self.seed * 1000 + n)
+        users = len(self.workload.clients)
+        while True:
+            with self.lock:
+                i = self.next
+                self.next += 1
+            if i >= self.total:
+                return
+            scheduled = start + i / self.rate
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            begun = time.time()
+            op = self.pick(rand)
+            method, status = getattr(self.workload, op)(
+                rand.randrange(users), rand)
+            done = time.time()
+            with self.lock:
+                self.results[method].append(
+                    (status, (done - scheduled) * 1000.0,
+                     (done - begun) * 1000.0, (begun - scheduled) * 1000.0))
+
+    def run(self):
+        start = time.time() + 0.1
+        threads = [threading.Thread(target=self.worker, args=(n, start))
+                   for n in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        methods = collections.OrderedDict()
+        for method in sorted(self.results):
+            samples = self.results[method]
+            n = float(len(samples))
+            statuses = collections.Counter(str(s[0]) for s in samples)
+            ok = statuses.get('200', 0) + statuses.get('204', 0)
+
+            def rate(*codes):
+                return round(sum(statuses.get(c, 0) for c in codes) / n, 4)
+            latencies = [s[1] for s in samples]
+            service = [s[2] for s in samples]
+            methods[method] = {
+                'calls': len(samples),
+                'throughput_rps': round(len(samples) / elapsed, 2),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'service_p50_ms': percentile(service, 50),
+                'service_p95_ms': percentile(service, 95),
+                'statuses': dict(statuses),
+                # 409: already registered, sold out...; 503: transaction
+                # retries exhausted under contention; throttled: 503
+                # from admission control
+                'conflict_rate': rate('409'),
+                'contention_rate': rate('503'),
+                'throttled_rate': rate('throttled'),
+                'error_rate': round(
+                    (n - ok) / n - rate('409', '503', 'throttled'), 4),
+            }
+        samples = [s for v in self.results.values() for s in v]
+        return {
+            'target_rps': self.rate,
+            'achieved_rps': round(len(samples) / elapsed, 2),
+            'elapsed_s': round(elapsed, 2),
+            'lag_p95_ms': percentile([s[3] for s in samples], 95),
+            'methods': methods,
+        }
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080',
+                        help='dev_appserver base URL')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='target requests per second')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of load')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='weighted operations (default: %(default)s)')
+    parser.add_argument('--tokens', help='file of OAuth2 access tokens, '
+                        'one simulated user per line')
+    parser.add_argument('--users', type=int, default=1,
+                        help='anonymous simulated users without --tokens')
+    parser.add_argument('--conferences', type=int, default=5,
+                        help='conferences to create first (needs --tokens)')
+    parser.add_argument('--sessions', type=int, default=5,
+                        help='sessions per created conference')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write JSON results here '
+                        'instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    if args.tokens:
+        with open(args.tokens) as f:
+            tokens = [line.strip() for line in f if line.strip()]
+        clients = [Client(args.url, t) for t in tokens]
+    else:
+        clients = [Client(args.url) for _ in range(args.users)]
+
+    mix = parseMix(args.mix, bool(args.tokens))
+    workload = Workload(clients, random.Random(args.seed))
+    workload.setUp(args.conferences if args.tokens else 0, args.sessions)
+
+    report = LoadGenerator(workload, mix, args.rate, args.duration,
+                           args.workers, args.seed).run()
+    report['users'] = len(clients)
+    report['mix'] = dict((op, round(bound - prev, 3)) for (op, bound), prev
+                         in zip(mix, [0] + [b for _, b in mix]))
+    report['conferences'] = len(workload.conferences)
+    report['sessions'] = len(workload.sessions)
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
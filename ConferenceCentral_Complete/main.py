@@ -14,19 +14,78 @@ forked from udacity/ud858 by MKM on 2015 May 22
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import csv
+import io
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi
+import rpcstats
+from rpcstats import instrumented
+
+# conference (and with it the endpoints library) is imported inside the
+# handlers that need ConferenceApi; the others use only models and the
+# modules built on it, so they start up without endpoints
+
+EXPORT_BATCH_SIZE = 100
+EXPORT_COLUMNS = ('websafeKey', 'name', 'date', 'startTime', 'duration',
+                  'typeOfSession', 'speakers', 'highlights')
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _chunks(iterable, size):
+    """Yield lists of up to size consecutive items from iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime API config, caches and RPC connections on a new instance."""
+        from conference import ConferenceApi
+        ConferenceApi._warmup()
+        self.response.set_status(200)
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @instrumented('crons/set_announcement')
     def get(self):
         """Set Announcement in Memcache."""
+        from conference import ConferenceApi
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
 
+class RebuildConferenceStatsHandler(webapp2.RequestHandler):
+    @instrumented('crons/rebuild_conference_stats')
+    def get(self):
+        """Recompute conference statistics counters from scratch."""
+        from conference import ConferenceApi
+        ConferenceApi._rebuildConferenceStats()
+        self.response.set_status(204)
+
+
+class RebuildUpcomingHandler(webapp2.RequestHandler):
+    @instrumented('crons/rebuild_upcoming')
+    def get(self):
+        """Recompute the upcoming conferences feed."""
+        from conference import ConferenceApi
+        ConferenceApi._rebuildUpcoming()
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    @instrumented('tasks/send_confirmation_email')
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -40,10 +99,20 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
+class IndexDocumentHandler(webapp2.RequestHandler):
+    @instrumented('tasks/index_document')
+    def post(self):
+        """Update search index for a conference or session."""
+        import textsearch
+        textsearch.indexDocument(self.request.get('websafeKey'))
+
+
 # added by MKM
 class MakeFeaturedSpeakerHandler(webapp2.RequestHandler):
+    @instrumented('tasks/handle_featured_speaker')
     def post(self):
         """Set Featured Speaker Announcement in Memcache."""
+        from conference import ConferenceApi
         ConferenceApi._handleFeaturedSpeaker(
             self.request.get('websafeConferenceKey'), 
             self.request.get('websafeSessionKey')
@@ -51,8 +120,212 @@ class MakeFeaturedSpeakerHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class ExportScheduleHandler(webapp2.RequestHandler):
+    @instrumented('export/schedule')
+    def get(self, websafeConferenceKey):
+        """Write conference's sessions with speaker names as CSV or NDJSON.
+
+        Sessions are read EXPORT_BATCH_SIZE at a time, bypassing the ndb
+        in-context cache, and each batch's speakers are fetched with one
+        get_multi before its rows are written, so memory held by the
+        handler doesn't grow with the size of the schedule.
+        """
+        from google.appengine.ext import ndb
+        from models import Session
+
+        fmt = self.request.get('format', 'csv')
+        if fmt not in EXPORT_CONTENT_TYPES:
+            self.abort(400, 'format must be one of: %s' %
+                       ', '.join(sorted(EXPORT_CONTENT_TYPES)))
+        try:
+            c_key = ndb.Key(urlsafe=websafeConferenceKey)
+        except Exception:
+            c_key = None
+        if not c_key or c_key.kind() != 'Conference' or not c_key.get():
+            self.abort(404, 'No conference found with key: %s' %
+                       websafeConferenceKey)
+
+        self.response.headers['Content-Type'] = EXPORT_CONTENT_TYPES[fmt]
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename="schedule.%s"' % fmt
+        if fmt == 'csv':
+            self.response.write(self._csv([EXPORT_COLUMNS]))
+
+        sessions = Session.query(ancestor=c_key) \
+            .order(Session.date, Session.startTime) \
+            .iter(batch_size=EXPORT_BATCH_SIZE, use_cache=False)
+        for chunk in _chunks(sessions, EXPORT_BATCH_SIZE):
+            s_keys = list(set(k for sess in chunk for k in sess.speaker))
+            names = dict((k, speaker.name) for k, speaker in
+                         zip(s_keys, ndb.get_multi(s_keys, use_cache=False))
+                         if speaker)
+            rows = [self._row(sess, names) for sess in chunk]
+            if fmt == 'csv':
+                self.response.write(self._csv(
+                    [[row[c] for c in EXPORT_COLUMNS] for row in rows]))
+            else:
+                self.response.write(''.join(
+                    json.dumps(row) + '\n' for row in rows))
+
+    @staticmethod
+    def _row(sess, speakerNames):
+        return {
+            'websafeKey': sess.key.urlsafe(),
+            'name': sess.name,
+            'date': sess.date and str(sess.date),
+            'startTime': sess.startTime and sess.startTime.strftime('%H:%M'),
+            'duration': sess.duration,
+            'typeOfSession': sess.typeOfSession,
+            'speakers': [speakerNames.get(k, '') for k in sess.speaker],
+            'highlights': sess.highlights,
+        }
+
+    @staticmethod
+    def _csv(rows):
+        """Return rows as UTF-8 CSV; list cells are joined with '; '."""
+        buf = io.BytesIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            writer.writerow([
+                u'; '.join(cell).encode('utf-8') if isinstance(cell, list)
+                else cell.encode('utf-8') if isinstance(cell, unicode)
+                else '' if cell is None else cell
+                for cell in row])
+        return buf.getvalue()
+
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    @instrumented('tasks/promote_waitlist')
+    def post(self):
+        """Register waitlisted users for a conference's free seats."""
+        from conference import ConferenceApi
+        ConferenceApi._promoteWaitlist(
+            self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class UpdateUpcomingHandler(webapp2.RequestHandler):
+    @instrumented('tasks/update_upcoming')
+    def post(self):
+        """Move a created or rescheduled conference in the upcoming feed."""
+        from conference import ConferenceApi
+        ConferenceApi._updateUpcoming(
+            self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class RecordWishlistAddHandler(webapp2.RequestHandler):
+    @instrumented('tasks/record_wishlist_add')
+    def post(self):
+        """Update session recommendations for a new wishlist entry."""
+        import recommend
+        recommend.recordWishlistAdd(self.request.get('userId'),
+                                    self.request.get('websafeSessionKey'))
+        self.response.set_status(204)
+
+
+class StartRecommendationsHandler(webapp2.RequestHandler):
+    @instrumented('crons/rebuild_recommendations')
+    def get(self):
+        """Start a job rebuilding session recommendations."""
+        import jobs
+        jobs.start('recommend.RecommendationMapper')
+        self.response.set_status(204)
+
+
+class RunJobHandler(webapp2.RequestHandler):
+    @instrumented('tasks/run_job')
+    def post(self):
+        """Run the next batch of a jobs.py shard, or a later job phase."""
+        import jobs
+        jobId = int(self.request.get('job'))
+        if self.request.get('finalize'):
+            jobs.finalizeJob(jobId)
+        elif self.request.get('reduce'):
+            jobs.startReduce(jobId)
+        elif self.request.get('bucket'):
+            jobs.reduceBucket(jobId, int(self.request.get('bucket')))
+        else:
+            jobs.runBatch(jobId, self.request.get('shard'),
+                          int(self.request.get('seq')),
+                          int(self.request.headers.get(
+                              'X-AppEngine-TaskRetryCount', 0)))
+        self.response.set_status(204)
+
+
+class StartSeatAuditHandler(webapp2.RequestHandler):
+    @instrumented('crons/audit_seats')
+    def get(self):
+        """Start a job reconciling seat counts with registrations."""
+        import jobs
+        jobs.start('seataudit.SeatAuditMapper')
+        self.response.set_status(204)
+
+
+class JobsHandler(webapp2.RequestHandler):
+    @instrumented('_admin/jobs')
+    def get(self):
+        """Return status of one job (?job=id) or of recent jobs as JSON."""
+        import jobs
+        jobId = self.request.get('job')
+        if jobId:
+            report = jobs.status(int(jobId))
+            if report is None:
+                self.abort(404, 'No job %s' % jobId)
+        else:
+            report = jobs.recentJobs()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report, indent=2, sort_keys=True))
+
+    @instrumented('_admin/jobs:post')
+    def post(self):
+        """Start (mapper, params, shards) or resume (job) a batch job."""
+        import jobs
+        action = self.request.get('action')
+        if action == 'start':
+            try:
+                jobId = jobs.start(
+                    self.request.get('mapper'),
+                    json.loads(self.request.get('params') or '{}'),
+                    int(self.request.get('shards') or jobs.DEFAULT_SHARDS))
+            except ValueError as e:
+                self.abort(400, str(e))
+        elif action == 'resume':
+            jobId = int(self.request.get('job'))
+            if not jobs.resume(jobId):
+                self.abort(404, 'No resumable job %s' % jobId)
+        else:
+            self.abort(400, 'action must be start or resume')
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(jobs.status(jobId), indent=2,
+                                       sort_keys=True))
+
+
+class StatsHandler(webapp2.RequestHandler):
+    @instrumented('_admin/stats')
+    def get(self):
+        """Return rolling per-endpoint latency and RPC stats as JSON."""
+        minutes = int(self.request.get('minutes') or 15)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(rpcstats.snapshot(minutes),
+                                       indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/rebuild_conference_stats', RebuildConferenceStatsHandler),
+    ('/crons/rebuild_upcoming', RebuildUpcomingHandler),
+    ('/crons/audit_seats', StartSeatAuditHandler),
+    ('/crons/rebuild_recommendations', StartRecommendationsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/handle_featured_speaker', MakeFeaturedSpeakerHandler),
+    ('/tasks/index_document', IndexDocumentHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/run_job', RunJobHandler),
+    ('/tasks/record_wishlist_add', RecordWishlistAddHandler),
+    ('/tasks/update_upcoming', UpdateUpcomingHandler),
+    ('/export/conference/([^/]+)/schedule', ExportScheduleHandler),
+    ('/_admin/stats', StatsHandler),
+    ('/_admin/jobs', JobsHandler),
 ], debug=True)
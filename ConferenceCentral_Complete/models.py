@@ -16,15 +16,9 @@ Speaker and Session classes added by MKM
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-import httplib
-import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
-class ConflictException(endpoints.ServiceException):
-    """ConflictException -- exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
-
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -41,6 +35,8 @@ class ProfileForm(messages.Message):
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -58,6 +54,35 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    updated         = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        # change feeds can't see deleted entities; leave a marker
+        if not future.get_exception():
+            ConferenceTombstone(id=key.urlsafe()).put()
+
+class ConferenceTombstone(ndb.Model):
+    """ConferenceTombstone -- a deleted conference, by websafe key"""
+    deleted         = ndb.DateTimeProperty(auto_now_add=True)
+
+class Announcement(ndb.Model):
+    """Announcement -- nearly sold out conferences; singleton maintained
+    by registrations/updates and reconciled by cron"""
+    conferences     = ndb.JsonProperty()    # websafeKey -> conference name
+    generation      = ndb.IntegerProperty(default=0, indexed=False)
+    reconciled      = ndb.DateTimeProperty(indexed=False)
+
+class UpcomingConferences(ndb.Model):
+    """UpcomingConferences -- conferences yet to start, soonest first;
+    singleton maintained by tasks after creates/updates, rebuilt by cron"""
+    items           = ndb.JsonProperty()    # [startDate, websafeKey], sorted
+    complete        = ndb.BooleanProperty(default=True, indexed=False)
+    changes         = ndb.JsonProperty()    # websafeKey -> [startDate, when]
+
+class ConferenceStatsShard(ndb.Model):
+    """ConferenceStatsShard -- one shard of the conference counters"""
+    counts          = ndb.JsonProperty()    # counter name -> count
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -73,10 +98,41 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
+
+class ConferenceChanges(messages.Message):
+    """ConferenceChanges -- conferences changed since a watermark"""
+    items           = messages.MessageField(ConferenceForm, 1, repeated=True)
+    deleted         = messages.StringField(2, repeated=True)
+    watermark       = messages.StringField(3)
+    nextPageToken   = messages.StringField(4)
+
+class FacetCount(messages.Message):
+    """FacetCount -- number of query results with a field value"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    facets = messages.MessageField(FacetCount, 3, repeated=True)
+
+class StatCount(messages.Message):
+    """StatCount -- name and count outbound message"""
+    name = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- conference counts outbound form message"""
+    conferences     = messages.IntegerField(1)
+    seats           = messages.IntegerField(2)
+    registrations   = messages.IntegerField(3)
+    cities          = messages.MessageField(StatCount, 4, repeated=True)
+    months          = messages.MessageField(StatCount, 5, repeated=True)
+    topics          = messages.MessageField(StatCount, 6, repeated=True)
 
 class Speaker(ndb.Model):
     """Speaker -- Speaker object; models speaker at a conference session"""
@@ -102,6 +158,8 @@ class SpeakerForm(messages.Message):
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple Speaker outbound form messages"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 class Session(ndb.Model):
     """Session -- Session object; belongs to Conference"""
@@ -123,18 +181,158 @@ class SessionForm(messages.Message):
     date            = messages.StringField(6)
     startTime       = messages.StringField(7)
     websafeKey      = messages.StringField(8)
+    conflictsWith   = messages.StringField(9, repeated=True)
 
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    nextPageToken = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- everything the conference page shows"""
+    conference      = messages.MessageField(ConferenceForm, 1)
+    sessions        = messages.MessageField(SessionForm, 2, repeated=True)
+    featuredSpeaker = messages.StringField(3)
+    announcement    = messages.StringField(4)
+    attending       = messages.BooleanField(5)  # unset when signed out
+    etag            = messages.StringField(6)
+    notModified     = messages.BooleanField(7)
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- one shard of a search term's posting list"""
+    token           = ndb.StringProperty()  # kind:term; None if saturated
+    postings        = ndb.JsonProperty()    # websafeKey -> weight
+    saturated       = ndb.BooleanProperty(default=False, indexed=False)
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- terms a document is currently indexed under"""
+    terms           = ndb.JsonProperty()    # term -> weight
 
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True)  # legacy
+    conferencesToAttend = ndb.KeyProperty(kind=Conference, repeated=True,
+                                          indexed=False)
     sessionWishlist = ndb.KeyProperty(kind=Session, repeated=True)
+    wishlistSchedule = ndb.JsonProperty()   # intervals.py index of wishlist
+
+    def attending(self):
+        """Return the set of keys of conferences the user registered for."""
+        return set(self.conferencesToAttend).union(
+            ndb.Key(urlsafe=wsck) for wsck in self.conferenceKeysToAttend)
+
+    def migrateAttending(self):
+        """Move legacy websafe keys into conferencesToAttend.
+
+        Returns True if the profile changed and needs to be put.
+        """
+        if not self.conferenceKeysToAttend:
+            return False
+        keys = list(self.conferencesToAttend)
+        seen = set(keys)
+        for wsck in self.conferenceKeysToAttend:
+            c_key = ndb.Key(urlsafe=wsck)
+            if c_key not in seen:
+                keys.append(c_key)
+                seen.add(c_key)
+        self.conferencesToAttend = keys
+        self.conferenceKeysToAttend = []
+        return True
+
+class ConferenceResult(messages.Message):
+    """ConferenceResult -- one key's result of a batch conference get"""
+    websafeKey      = messages.StringField(1)
+    found           = messages.BooleanField(2)
+    conference      = messages.MessageField(ConferenceForm, 3)
+
+class ConferenceResults(messages.Message):
+    """ConferenceResults -- batch conference get outbound form message"""
+    items = messages.MessageField(ConferenceResult, 1, repeated=True)
+
+class SessionResult(messages.Message):
+    """SessionResult -- one key's result of a batch session get"""
+    websafeKey      = messages.StringField(1)
+    found           = messages.BooleanField(2)
+    session         = messages.MessageField(SessionForm, 3)
+
+class SessionResults(messages.Message):
+    """SessionResults -- batch session get outbound form message"""
+    items = messages.MessageField(SessionResult, 1, repeated=True)
+
+class SpeakerResult(messages.Message):
+    """SpeakerResult -- one key's result of a batch speaker get"""
+    websafeKey      = messages.StringField(1)
+    found           = messages.BooleanField(2)
+    speaker         = messages.MessageField(SpeakerForm, 3)
+
+class SpeakerResults(messages.Message):
+    """SpeakerResults -- batch speaker get outbound form message"""
+    items = messages.MessageField(SpeakerResult, 1, repeated=True)
+
+class SessionRecommendation(ndb.Model):
+    """SessionRecommendation -- co-wishlisted sessions; id is websafeKey"""
+    counts          = ndb.JsonProperty()    # websafeKey -> co-occurrences
+    neighbours      = ndb.JsonProperty()    # top websafeKeys, best first
+
+class WishlistBump(ndb.Model):
+    """WishlistBump -- recommendation rows one wishlist add has yet to bump"""
+    others          = ndb.JsonProperty()    # co-wishlisted websafeKeys
+    pending         = ndb.JsonProperty()    # row ids not yet bumped
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat; id is conference:user"""
+    conference      = ndb.StringProperty()  # websafeConferenceKey
+    userId          = ndb.StringProperty(indexed=False)
+    joined          = ndb.DateTimeProperty(auto_now_add=True)
+
+class WaitlistForm(messages.Message):
+    """WaitlistForm -- user's place on a conference waitlist"""
+    websafeConferenceKey = messages.StringField(1)
+    position        = messages.IntegerField(2)
+    joined          = messages.StringField(3)
+
+class MapperJob(ndb.Model):
+    """MapperJob -- a batch job run by jobs.py over one entity kind"""
+    mapper          = ndb.StringProperty(indexed=False)  # module.Class
+    params          = ndb.JsonProperty()
+    shards          = ndb.IntegerProperty(indexed=False)
+    status          = ndb.StringProperty()  # running, failed, done
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    finished        = ndb.DateTimeProperty(indexed=False)
+    result          = ndb.JsonProperty()    # set by Mapper.finalize()
+
+class MapperShard(ndb.Model):
+    """MapperShard -- progress through one key range of a MapperJob"""
+    job             = ndb.KeyProperty(kind=MapperJob, indexed=False)
+    startKey        = ndb.KeyProperty(indexed=False)   # inclusive
+    endKey          = ndb.KeyProperty(indexed=False)   # exclusive
+    cursor          = ndb.StringProperty(indexed=False)
+    seq             = ndb.IntegerProperty(default=0, indexed=False)
+    processed       = ndb.IntegerProperty(default=0, indexed=False)
+    batches         = ndb.IntegerProperty(default=0, indexed=False)
+    done            = ndb.BooleanProperty(default=False, indexed=False)
+    counters        = ndb.JsonProperty()    # summed map_batch() results
+    error           = ndb.TextProperty()
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class SeatAuditReport(ndb.Model):
+    """SeatAuditReport -- audit outcome for one bucket of conferences"""
+    checked         = ndb.IntegerProperty(indexed=False)
+    mismatches      = ndb.JsonProperty()
+    orphaned        = ndb.JsonProperty()    # registrations, by missing conf
+
+class MapperPartial(ndb.Model):
+    """MapperPartial -- one batch's output for one bucket of a job"""
+    counts          = ndb.JsonProperty()
+
+class MapperReduce(ndb.Model):
+    """MapperReduce -- marks one bucket of a job as reduced"""
+    finished        = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -163,3 +361,4 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    facets = messages.BooleanField(2)
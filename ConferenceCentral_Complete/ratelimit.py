@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+ratelimit.py -- per-user and per-endpoint admission control
+
+@ratelimited endpoints methods take a token from the caller's bucket for
+that method and from the method's bucket shared by all callers, as
+configured in settings.RATE_LIMITS; an empty bucket fails the request with
+ServiceUnavailableException (503; Endpoints v1 passes no 429 through),
+its message starting with THROTTLED and saying when to retry.
+
+Buckets are memcache counters of tokens spent per refill window (the time
+an empty bucket takes to fill).  A bucket allows `burst` tokens plus
+`rate` per second elapsed in the window, so unused tokens never carry
+over more than one window.  Instances lease up to a tenth of the burst
+with one memcache incr and spend it locally, and remember an empty bucket
+until it next refills, so most admitted and rejected requests cost no
+memcache call at all.  If memcache is unavailable requests are admitted.
+
+"""
+
+import functools
+import logging
+import math
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from errors import ServiceUnavailableException
+import rpcstats
+import settings
+
+MEMCACHE_BUCKET_TPL = "RATE_%d_%s"      # window, bucket
+THROTTLED = 'Throttled'                 # message prefix of rejections
+LEASE_FRACTION = 10                     # lease at most burst / 10 tokens
+
+LIMITS = settings.RATE_LIMITS           # method -> {'user'|'global': (rate, burst)}
+
+_leases = {}                            # bucket -> [window, tokens, retryAt]
+_lock = threading.Lock()
+
+rpcstats.registerMetric('throttled')
+
+
+def reset():
+    """Forget this instance's leases (for tests and benchmarks)."""
+    with _lock:
+        _leases.clear()
+
+
+def _spend(bucket, size, window, ttl):
+    """Add size to a bucket's spent counter; return the new total."""
+    key = MEMCACHE_BUCKET_TPL % (window, bucket)
+    spent = memcache.incr(key, delta=size)
+    if spent is None:
+        # add() sets an expiry on new counters; incr() can't
+        if memcache.add(key, size, time=ttl):
+            return size
+        spent = memcache.incr(key, delta=size)
+    return spent
+
+
+def _take(bucket, limit, now):
+    """Take one token from a bucket; return False if it's empty."""
+    rate, burst = limit
+    period = float(burst) / rate
+    window = int(now // period)
+    start = window * period
+
+    with _lock:
+        lease = _leases.get(bucket)
+        if lease and lease[0] == window:
+            if lease[1] > 0:
+                lease[1] -= 1
+                return True
+            if now < lease[2]:
+                return False
+
+    allowance = burst + int(rate * (now - start))
+    size = max(1, burst // LEASE_FRACTION)
+    try:
+        spent = _spend(bucket, size, window, int(period * 2) + 1)
+    except Exception:
+        spent = None
+    if spent is None:
+        logging.warning('ratelimit: memcache unavailable; admitting')
+        return True
+
+    granted = min(size, allowance - (spent - size))
+    with _lock:
+        if granted > 0:
+            _leases[bucket] = [window, granted - 1, now]
+        else:
+            # empty until enough tokens refill to cover what's spent
+            retryAt = min(start + (spent - burst) / float(rate),
+                          start + period)
+            _leases[bucket] = [window, 0, retryAt]
+    return granted > 0
+
+
+def _retryAfter(bucket, now):
+    """Return whole seconds until an empty bucket has tokens again."""
+    with _lock:
+        lease = _leases.get(bucket)
+    return max(1, int(math.ceil(lease[2] - now))) if lease else 1
+
+
+def admit(method, userId=None, now=None):
+    """Take a token for a call to method; raise if a bucket is empty."""
+    limits = LIMITS.get(method)
+    if not limits:
+        return
+    now = time.time() if now is None else now
+    bucket = '%s:%s' % (method, userId)
+    if userId and 'user' in limits and \
+            not _take(bucket, limits['user'], now):
+        rpcstats.incrementCounter('throttled')
+        raise ServiceUnavailableException(
+            '%s: too many %s requests; retry in %d s.' % (
+                THROTTLED, method, _retryAfter(bucket, now)))
+    if 'global' in limits and not _take(method, limits['global'], now):
+        rpcstats.incrementCounter('throttled')
+        raise ServiceUnavailableException(
+            '%s: %s is busy; retry in %d s.' % (
+                THROTTLED, method, _retryAfter(method, now)))
+
+
+def ratelimited(func):
+    """Decorator applying admission control to an endpoints method."""
+    @functools.wraps(func)
+    def wrapper(self, request):
+        user = endpoints.get_current_user()
+        admit(func.__name__, user and user.email())
+        return func(self, request)
+    return wrapper
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+recommend.py -- "people who wishlisted this also wishlisted" sessions
+
+RecommendationMapper is a jobs.py job over Profile.  For every pair of
+sessions of the same conference on one wishlist it emits a co-occurrence
+count, bucketed by range of session ids; the ranges are split from the
+existing rows once, when the job starts.  Each bucket's reduce() sums its
+sessions' sparse rows and stores them, with the top REC_TOP_K neighbours,
+as one SessionRecommendation per session, read back with a single get,
+then deletes the stale rows of its own range.
+
+Between full rebuilds, recordWishlistAdd() (run from a task after each
+wishlist add) bumps the affected rows in place, so counts stay roughly
+current; the next rebuild replaces them with exact ones.  A WishlistBump
+per (user, session) records which rows are still to bump, so a retried
+task doesn't count the same add twice.
+
+"""
+
+import bisect
+
+from google.appengine.ext import ndb
+
+import jobs
+from models import Profile, SessionRecommendation, WishlistBump
+
+REC_BUCKETS = 16
+REC_TOP_K = 10
+PUT_BATCH_SIZE = 500
+
+
+def _topK(counts):
+    return [k for k, n in sorted(counts.items(),
+                                 key=lambda kn: (-kn[1], kn[0]))[:REC_TOP_K]]
+
+
+class RecommendationMapper(jobs.Mapper):
+    """Rebuild session co-occurrence rows from every wishlist."""
+    kind = 'Profile'
+    batch_size = 100
+    buckets = REC_BUCKETS
+
+    def __init__(self, params=None):
+        super(RecommendationMapper, self).__init__(params)
+        self.splits = self.params.get('splits', [])
+
+    @classmethod
+    def prepare(cls, params):
+        """Split existing rows' session ids into one range per bucket."""
+        params['splits'] = [k.id() for k in
+                            jobs.splitKeys('SessionRecommendation', REC_BUCKETS)]
+        return params
+
+    def _bucket(self, websafeSessionKey):
+        return bisect.bisect_right(self.splits, websafeSessionKey)
+
+    def map_batch(self, keys):
+        buckets = [{} for _ in range(REC_BUCKETS)]
+        pairs = 0
+        for prof in ndb.get_multi(keys):
+            # only sessions of the same conference recommend each other
+            byConference = {}
+            for s_key in (prof and prof.sessionWishlist) or []:
+                byConference.setdefault(s_key.parent(), []).append(
+                    s_key.urlsafe())
+            for wssks in byConference.values():
+                for a in wssks:
+                    row = buckets[self._bucket(a)].setdefault(a, {})
+                    for b in wssks:
+                        if a != b:
+                            row[b] = row.get(b, 0) + 1
+                            pairs += 1
+        self.emit(buckets)
+        return {'profiles': len(keys), 'pairs': pairs}
+
+    def reduce(self, job, bucket, partials):
+        """Store summed rows of one bucket of sessions; drop stale ones."""
+        rows = {}
+        for partial in partials:
+            for a, counts in partial.items():
+                row = rows.setdefault(a, {})
+                for b, n in counts.items():
+                    row[b] = row.get(b, 0) + n
+
+        recs = [SessionRecommendation(id=a, counts=row, neighbours=_topK(row))
+                for a, row in rows.items()]
+        for i in range(0, len(recs), PUT_BATCH_SIZE):
+            ndb.put_multi(recs[i:i + PUT_BATCH_SIZE])
+
+        # with few rows there may be fewer ranges than buckets
+        bounds = [None] + self.splits + [None]
+        if bucket >= len(bounds) - 1:
+            return
+        q = SessionRecommendation.query()
+        if bounds[bucket]:
+            q = q.filter(SessionRecommendation.key >=
+                         ndb.Key(SessionRecommendation, bounds[bucket]))
+        if bounds[bucket + 1]:
+            q = q.filter(SessionRecommendation.key <
+                         ndb.Key(SessionRecommendation, bounds[bucket + 1]))
+        stale = [k for k in q.iter(keys_only=True, batch_size=1000)
+                 if k.id() not in rows]
+        for i in range(0, len(stale), PUT_BATCH_SIZE):
+            ndb.delete_multi(stale[i:i + PUT_BATCH_SIZE])
+
+
+@ndb.transactional(xg=True)
+def _bump(b_key, websafeSessionKey, others):
+    """Count others against one row, unless this add already did."""
+    r_key = ndb.Key(SessionRecommendation, websafeSessionKey)
+    bump, rec = ndb.get_multi([b_key, r_key])
+    if websafeSessionKey not in bump.pending:
+        return
+    rec = rec or SessionRecommendation(key=r_key, counts={})
+    for other in others:
+        rec.counts[other] = rec.counts.get(other, 0) + 1
+    rec.neighbours = _topK(rec.counts)
+    bump.pending.remove(websafeSessionKey)
+    ndb.put_multi([bump, rec])
+
+
+def recordWishlistAdd(userId, websafeSessionKey):
+    """Count a newly wishlisted session against the rest of the wishlist."""
+    s_key = ndb.Key(urlsafe=websafeSessionKey)
+    prof = ndb.Key(Profile, userId).get()
+    if not prof or s_key not in prof.sessionWishlist:
+        return
+    others = [k.urlsafe() for k in prof.sessionWishlist
+              if k != s_key and k.parent() == s_key.parent()]
+    if not others:
+        return
+    # a retry finds the bump of the first attempt, with its own others
+    bump = WishlistBump.get_or_insert('%s:%s' % (userId, websafeSessionKey),
+                                      others=others,
+                                      pending=[websafeSessionKey] + others)
+    # one small transaction per row; they share the bump, so run in turn
+    for row in list(bump.pending):
+        _bump(bump.key, row, bump.others if row == websafeSessionKey
+              else [websafeSessionKey])
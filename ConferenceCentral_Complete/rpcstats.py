@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+rpcstats.py -- per-endpoint latency and RPC instrumentation
+
+@instrumented handlers record wall time plus the datastore, memcache and
+task queue RPCs they issue (counted by an APIProxy pre-call hook).  Counts accumulate
+per instance and are folded into per-minute memcache counters at most every
+FLUSH_INTERVAL seconds, so the steady-state cost is a dict update per RPC
+and one batched memcache call per instance every few seconds.  snapshot()
+merges the last few minutes into rolling histograms for /_admin/stats.
+
+"""
+
+import collections
+import functools
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+MEMCACHE_STATS_TPL = "STATS_%d_%s_%s"    # window, endpoint, metric
+WINDOW_SECONDS = 60
+WINDOWS_KEPT = 60                       # one hour of per-minute windows
+FLUSH_INTERVAL = 10                     # seconds; None disables flushing
+
+# upper bounds (ms) of latency histogram buckets; last bucket is open
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+RPC_METRICS = {
+    ('datastore_v3', 'Get'): 'ds_get',
+    ('datastore_v3', 'Put'): 'ds_put',
+    ('datastore_v3', 'Delete'): 'ds_delete',
+    ('datastore_v3', 'RunQuery'): 'ds_query',
+    ('datastore_v3', 'Next'): 'ds_query',
+    ('datastore_v3', 'Commit'): 'ds_commit',
+    ('taskqueue', 'BulkAdd'): 'tq_add',
+}
+
+METRICS = ['calls', 'errors', 'ms', 'ds_get', 'ds_put', 'ds_delete',
+           'ds_query', 'ds_commit', 'ds_other', 'mc_ops', 'tq_add'] + \
+          ['lat_%d' % b for b in LATENCY_BUCKETS] + ['lat_inf']
+
+_endpoints = set()
+_pending = collections.defaultdict(int)
+_lock = threading.Lock()
+_local = threading.local()
+_state = {'lastFlush': time.time(), 'hookedProxy': None}
+
+
+def registerMetric(metric):
+    """Declare an extra per-endpoint counter (call at import time)."""
+    if metric not in METRICS:
+        METRICS.append(metric)
+
+
+def _preCallHook(service, call, request, response):
+    """Count RPCs issued while an instrumented handler runs."""
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    metric = RPC_METRICS.get((service, call))
+    if metric is None:
+        metric = 'mc_ops' if service == 'memcache' else \
+                 'ds_other' if service == 'datastore_v3' else None
+    if metric:
+        counts[metric] += 1
+
+
+def _installHook():
+    # testbeds swap in a fresh stub map, so check the current one each time
+    proxy = apiproxy_stub_map.apiproxy
+    if _state['hookedProxy'] is not proxy:
+        proxy.GetPreCallHooks().Append('rpcstats', _preCallHook)
+        _state['hookedProxy'] = proxy
+
+
+def incrementCounter(metric, delta=1):
+    """Add to a counter of the instrumented handler currently running."""
+    counts = getattr(_local, 'counts', None)
+    if counts is not None:
+        counts[metric] += delta
+
+
+def _latencyBucket(ms):
+    for bound in LATENCY_BUCKETS:
+        if ms <= bound:
+            return 'lat_%d' % bound
+    return 'lat_inf'
+
+
+def _record(name, counts, ms, failed):
+    window = int(time.time()) // WINDOW_SECONDS
+    counts['calls'] += 1
+    counts['ms'] += int(round(ms))
+    counts[_latencyBucket(ms)] += 1
+    if failed:
+        counts['errors'] += 1
+    with _lock:
+        for metric, value in counts.items():
+            _pending[(window, name, metric)] += value
+
+
+def flush(force=False):
+    """Fold this instance's pending counts into shared memcache counters."""
+    now = time.time()
+    if not force and (FLUSH_INTERVAL is None or
+                      now - _state['lastFlush'] < FLUSH_INTERVAL):
+        return
+    with _lock:
+        if not _pending:
+            _state['lastFlush'] = now
+            return
+        deltas = dict((MEMCACHE_STATS_TPL % k, v)
+                      for k, v in _pending.items())
+        _pending.clear()
+        _state['lastFlush'] = now
+    try:
+        # add() sets expiry on new counters; offset_multi can't
+        memcache.add_multi(dict.fromkeys(deltas, 0),
+                           time=WINDOW_SECONDS * (WINDOWS_KEPT + 1))
+        memcache.offset_multi(deltas)
+    except Exception:
+        logging.warning('rpcstats: dropped %d counters', len(deltas),
+                        exc_info=True)
+
+
+def instrumented(arg):
+    """Decorator recording latency and RPC counts for a handler.
+
+    Use bare on endpoints methods (stats are keyed by function name) or
+    as @instrumented('name') on webapp2 handler methods.
+    """
+    def decorate(func, name):
+        _endpoints.add(name)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'counts', None) is not None:
+                return func(*args, **kwargs)    # nested; outer one counts
+            _installHook()
+            _local.counts = counts = collections.defaultdict(int)
+            failed = True
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                _local.counts = None
+                _record(name, counts, (time.time() - start) * 1000, failed)
+                flush()
+        return wrapper
+
+    if callable(arg):
+        return decorate(arg, arg.__name__)
+    return lambda func: decorate(func, arg)
+
+
+def _percentile(histogram, calls, pct):
+    """Estimate percentile (ms) as upper bound of the bucket it falls in."""
+    target = calls * pct / 100.0
+    seen = 0
+    for bound in LATENCY_BUCKETS:
+        seen += histogram['lat_%d' % bound]
+        if seen >= target:
+            return bound
+    return None     # beyond the last bucket
+
+
+def snapshot(minutes=15):
+    """Return rolling stats for the last given minutes, by endpoint."""
+    flush(force=True)
+    now = int(time.time()) // WINDOW_SECONDS
+    windows = range(now - min(minutes, WINDOWS_KEPT) + 1, now + 1)
+    keys = [MEMCACHE_STATS_TPL % (w, name, metric)
+            for w in windows for name in _endpoints for metric in METRICS]
+    values = {}
+    for i in range(0, len(keys), 1000):
+        values.update(memcache.get_multi(keys[i:i + 1000]))
+
+    stats = {}
+    for name in sorted(_endpoints):
+        totals = dict((metric, sum(
+            values.get(MEMCACHE_STATS_TPL % (w, name, metric), 0)
+            for w in windows)) for metric in METRICS)
+        calls = totals.pop('calls')
+        if not calls:
+            continue
+        histogram = dict((m, totals.pop(m)) for m in list(totals)
+                         if m.startswith('lat_'))
+        stats[name] = {
+            'calls': calls,
+            'errors': totals.pop('errors'),
+            'mean_ms': round(totals.pop('ms') / float(calls), 1),
+            'p50_ms': _percentile(histogram, calls, 50),
+            'p95_ms': _percentile(histogram, calls, 95),
+            'histogram': histogram,
+            'per_call': dict((m, round(v / float(calls), 2))
+                             for m, v in totals.items() if v),
+        }
+    return stats
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+seataudit.py -- reconcile Conference.seatsAvailable with registrations
+
+SeatAuditMapper is a jobs.py job over Profile that counts registrations
+per conference from Profile.attending(), emitting the counts bucketed
+by conference key range; the ranges are split once, when the job starts.
+Each bucket's reduce() sums them, scans only its own range of conference
+keys, compares the totals with the stored seat counts, repairs mismatches
+transactionally (unless the job was started with params {"repair":
+false}) and saves a SeatAuditReport.  No task holds more than one batch
+of profiles or one bucket of conferences in memory.
+
+"""
+
+import bisect
+
+from google.appengine.ext import ndb
+
+import jobs
+from models import Conference, SeatAuditReport
+
+AUDIT_BUCKETS = 16
+GET_BATCH_SIZE = 500
+MAX_REPORTED_MISMATCHES = 100
+
+
+def _reportKey(jobId, bucket):
+    return ndb.Key(SeatAuditReport, '%d:%d' % (jobId, bucket))
+
+
+class SeatAuditMapper(jobs.Mapper):
+    """Count registrations per conference, then check seat counts."""
+    kind = 'Profile'
+    batch_size = 200
+    buckets = AUDIT_BUCKETS
+
+    def __init__(self, params=None):
+        super(SeatAuditMapper, self).__init__(params)
+        self.splits = [ndb.Key(urlsafe=k)
+                       for k in self.params.get('splits', ())]
+
+    @classmethod
+    def prepare(cls, params):
+        """Split the conference key space into one range per bucket."""
+        params['splits'] = [k.urlsafe() for k in
+                            jobs.splitKeys('Conference', AUDIT_BUCKETS)]
+        return params
+
+    def _bucket(self, c_key):
+        return bisect.bisect_right(self.splits, c_key)
+
+    def map_batch(self, keys):
+        buckets = [{} for _ in range(AUDIT_BUCKETS)]
+        registrations = 0
+        for prof in ndb.get_multi(keys):
+            for c_key in (prof.attending() if prof else ()):
+                wsck = c_key.urlsafe()
+                counts = buckets[self._bucket(c_key)]
+                counts[wsck] = counts.get(wsck, 0) + 1
+                registrations += 1
+        self.emit(buckets)
+        return {'profiles': len(keys), 'registrations': registrations}
+
+    def reduce(self, job, bucket, partials):
+        """Check and repair seat counts of one bucket of conferences."""
+        from conference import ConferenceApi
+        registered = {}
+        for counts in partials:
+            for wsck, count in counts.items():
+                registered[wsck] = registered.get(wsck, 0) + count
+
+        # with few conferences there may be fewer ranges than buckets
+        bounds = [None] + self.splits + [None]
+        c_keys = []
+        if bucket < len(bounds) - 1:
+            q = Conference.query()
+            if bounds[bucket]:
+                q = q.filter(Conference.key >= bounds[bucket])
+            if bounds[bucket + 1]:
+                q = q.filter(Conference.key < bounds[bucket + 1])
+            c_keys = list(q.order(Conference.key).iter(keys_only=True,
+                                                       batch_size=1000))
+        repair = self.params.get('repair', True)
+        mismatches = []
+        for i in range(0, len(c_keys), GET_BATCH_SIZE):
+            for conf in ndb.get_multi(c_keys[i:i + GET_BATCH_SIZE]):
+                if not conf:
+                    continue
+                wsck = conf.key.urlsafe()
+                count = registered.pop(wsck, 0)
+                expected = max(0, (conf.maxAttendees or 0) - count)
+                if conf.seatsAvailable == expected:
+                    continue
+                mismatch = {'conference': wsck, 'name': conf.name,
+                            'maxAttendees': conf.maxAttendees,
+                            'registered': count,
+                            'seatsAvailable': conf.seatsAvailable,
+                            'expected': expected}
+                if repair:
+                    # registrations made since the scan would be undone by
+                    # a repair from the scanned count; only repair
+                    # conferences untouched since the job started
+                    if ConferenceApi._repairSeats(conf.key, count,
+                                                  since=job.created):
+                        mismatch['repaired'] = True
+                    else:
+                        mismatch['skipped'] = 'conference changed'
+                mismatches.append(mismatch)
+
+        SeatAuditReport(key=_reportKey(job.key.id(), bucket),
+                        checked=len(c_keys), mismatches=mismatches,
+                        orphaned=registered).put()
+
+    def report(self, job):
+        reports = [r for r in ndb.get_multi(
+            [_reportKey(job.key.id(), b) for b in range(AUDIT_BUCKETS)]) if r]
+        mismatches = [m for r in reports for m in r.mismatches]
+        return {
+            'bucketsDone': len(reports),
+            'buckets': AUDIT_BUCKETS,
+            'checked': sum(r.checked for r in reports),
+            'mismatched': len(mismatches),
+            'repaired': sum(1 for m in mismatches if m.get('repaired')),
+            'mismatches': mismatches[:MAX_REPORTED_MISMATCHES],
+            'orphaned': dict(kv for r in reports
+                             for kv in r.orphaned.items()),
+        }
@@ -16,3 +16,18 @@ WEB_CLIENT_ID = '1065752124969-lasbkv6m4vckg5t4ev14t4h98f483euf.apps.googleuserc
 ANDROID_CLIENT_ID = '1065752124969-ccube26gfneejhg8nou8efft9q2dtebj.apps.googleusercontent.com'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Admission control (ratelimit.py) for @ratelimited endpoints methods:
+# method -> {'user': (rate, burst), 'global': (rate, burst)}, where rate is
+# tokens per second and burst the bucket size, per user and for all users.
+RATE_LIMITS = {
+    'queryConferences': {'user': (2, 20), 'global': (200, 2000)},
+    'searchConferences': {'user': (2, 20), 'global': (200, 2000)},
+    'searchSessions': {'user': (2, 20), 'global': (200, 2000)},
+    'getConferencesByKeys': {'user': (1, 10), 'global': (100, 1000)},
+    'createConference': {'user': (0.1, 5)},
+    'registerForConference': {'user': (0.5, 10), 'global': (50, 500)},
+    'unregisterFromConference': {'user': (0.5, 10), 'global': (50, 500)},
+    'joinWaitlist': {'user': (0.5, 10), 'global': (50, 500)},
+    'addSessionToWishlist': {'user': (1, 20), 'global': (100, 1000)},
+}
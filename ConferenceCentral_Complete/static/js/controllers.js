@@ -270,7 +270,9 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
         {enumValue: 'MONTH', displayName: 'Start month'},
-        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
+        {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'},
+        {enumValue: 'START_DATE', displayName: 'Start date (yyyy-mm-dd)'},
+        {enumValue: 'END_DATE', displayName: 'End date (yyyy-mm-dd)'}
     ]
 
     /**
@@ -293,6 +295,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the result counts by city, topic and month for the current filters.
+     * @type {Array}
+     */
+    $scope.facets = [];
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -408,6 +416,31 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         }
     };
 
+    /**
+     * Adds an equality filter for the facet value and queries again.
+     *
+     * @param facet a FacetCount returned by queryConferences
+     */
+    $scope.addFacetFilter = function (facet) {
+        var field, operator;
+        angular.forEach($scope.filtereableFields, function (f) {
+            if (f.enumValue == facet.field) {
+                field = f;
+            }
+        });
+        angular.forEach($scope.operators, function (o) {
+            if (o.enumValue == 'EQ') {
+                operator = o;
+            }
+        });
+        $scope.filters.push({
+            field: field,
+            operator: operator,
+            value: facet.value
+        });
+        $scope.queryConferences();
+    };
+
     /**
      * Query the conferences depending on the tab currently selected.
      *
@@ -424,11 +457,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Invokes the conference.queryConferences API, or syncs the cached conferences when there are no filters.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            facets: true
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -440,6 +474,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (sendFilters.filters.length == 0 && window.localStorage) {
+            $scope.syncConferences();
+            return;
+        }
         $scope.loading = true;
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
@@ -462,12 +500,136 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         angular.forEach(resp.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
+                        $scope.facets = resp.facets || [];
                     }
                     $scope.submitted = true;
                 });
             });
     }
 
+    /**
+     * The localStorage key of the cached conference list: {watermark: string, conferences: {websafeKey: conference}}.
+     * @type {string}
+     */
+    var CONFERENCE_CACHE_KEY = 'conferenceCache';
+
+    var loadConferenceCache = function () {
+        try {
+            return JSON.parse(localStorage.getItem(CONFERENCE_CACHE_KEY)) || {conferences: {}};
+        } catch (e) {
+            return {conferences: {}};
+        }
+    };
+
+    var saveConferenceCache = function (cache) {
+        try {
+            localStorage.setItem(CONFERENCE_CACHE_KEY, JSON.stringify(cache));
+        } catch (e) {
+            // Quota exceeded; the next visit does a full sync.
+            localStorage.removeItem(CONFERENCE_CACHE_KEY);
+        }
+    };
+
+    /**
+     * Counts conferences by city, topic and month, like the facets returned by queryConferences.
+     *
+     * @param conferences
+     * @returns {Array}
+     */
+    var countFacets = function (conferences) {
+        var counts = {CITY: {}, TOPIC: {}, MONTH: {}};
+        var add = function (field, value) {
+            if (value) {
+                counts[field][value] = (counts[field][value] || 0) + 1;
+            }
+        };
+        angular.forEach(conferences, function (conference) {
+            add('CITY', conference.city);
+            add('MONTH', conference.month);
+            var topics = {};
+            angular.forEach(conference.topics, function (topic) {
+                if (!topics[topic]) {
+                    topics[topic] = true;
+                    add('TOPIC', topic);
+                }
+            });
+        });
+        var facets = [];
+        angular.forEach(['CITY', 'TOPIC', 'MONTH'], function (field) {
+            var values = [];
+            angular.forEach(counts[field], function (count, value) {
+                values.push({field: field, value: value, count: count});
+            });
+            values.sort(function (a, b) {
+                return b.count - a.count || (a.value < b.value ? -1 : a.value > b.value ? 1 : 0);
+            });
+            facets = facets.concat(values);
+        });
+        return facets;
+    };
+
+    /**
+     * Brings the cached conference list up to date with the conference.getConferenceChanges method, which
+     * returns only the conferences changed or deleted since the last sync, and shows it.
+     */
+    $scope.syncConferences = function () {
+        var cache = loadConferenceCache();
+        var watermark, changed = 0;
+        var fetchPage = function (pageToken) {
+            var params = {};
+            if (cache.watermark) {
+                params.since = cache.watermark;
+            }
+            if (pageToken) {
+                params.pageToken = pageToken;
+            }
+            gapi.client.conference.getConferenceChanges(params).
+                execute(function (resp) {
+                    $scope.$apply(function () {
+                        if (resp.error) {
+                            // The request has failed.
+                            $scope.loading = false;
+                            var errorMessage = resp.error.message || '';
+                            $scope.messages = 'Failed to sync conferences : ' + errorMessage;
+                            $scope.alertStatus = 'warning';
+                            $log.error($scope.messages);
+                            return;
+                        }
+                        // The first page's watermark covers every page.
+                        watermark = watermark || resp.watermark;
+                        changed += (resp.items || []).length + (resp.deleted || []).length;
+                        angular.forEach(resp.items, function (conference) {
+                            cache.conferences[conference.websafeKey] = conference;
+                        });
+                        angular.forEach(resp.deleted, function (websafeKey) {
+                            delete cache.conferences[websafeKey];
+                        });
+                        if (resp.nextPageToken) {
+                            fetchPage(resp.nextPageToken);
+                            return;
+                        }
+                        cache.watermark = watermark;
+                        saveConferenceCache(cache);
+
+                        $scope.loading = false;
+                        $scope.messages = 'Synced conferences : ' + changed + ' changed';
+                        $scope.alertStatus = 'success';
+                        $scope.conferences = [];
+                        angular.forEach(cache.conferences, function (conference) {
+                            $scope.conferences.push(conference);
+                        });
+                        $scope.conferences.sort(function (a, b) {
+                            return a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+                        });
+                        $scope.facets = countFacets($scope.conferences);
+                        $scope.submitted = true;
+                    });
+                });
+        };
+        $scope.loading = true;
+        fetchPage(null);
+    };
+
     /**
      * Invokes the conference.getConferencesCreated method.
      */
@@ -540,6 +702,35 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
 });
 
 
+/**
+ * @ngdoc controller
+ * @name UpcomingConferencesCtrl
+ *
+ * @description
+ * A controller used for the upcoming conferences list on the home page.
+ */
+conferenceApp.controllers.controller('UpcomingConferencesCtrl', function ($scope, $log) {
+
+    $scope.conferences = [];
+
+    /**
+     * Invokes the conference.getUpcomingConferences method.
+     */
+    $scope.init = function () {
+        gapi.client.conference.getUpcomingConferences({days: 30, limit: 10}).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    if (resp.error) {
+                        $log.error('Failed to get upcoming conferences : ' + (resp.error.message || ''));
+                    } else {
+                        $scope.conferences = resp.items || [];
+                    }
+                });
+            });
+    };
+});
+
+
 /**
  * @ngdoc controller
  * @name ConferenceDetailCtrl
@@ -554,12 +745,13 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
 
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method and sets the returned conference, its sessions,
+     * featured speaker and the user's registration status in the $scope.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        gapi.client.conference.getConferenceDetail({
             websafeConferenceKey: $routeParams.websafeConferenceKey
         }).execute(function (resp) {
             $scope.$apply(function () {
@@ -574,27 +766,15 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = resp.result.conference;
+                    $scope.sessions = resp.result.sessions || [];
+                    $scope.featuredSpeaker = resp.result.featuredSpeaker;
+                    $scope.announcement = resp.result.announcement;
+                    if (resp.result.attending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+textsearch.py -- tokenized inverted index over conferences and sessions
+
+Each (kind, term) has a posting list of websafe document keys -> weight,
+split over SEARCH_SHARDS SearchTerm entities by document so that writes
+for different documents rarely contend.  A SearchDocument remembers what
+each document was last indexed under, so re-indexing only touches the
+terms that changed.  Index updates run in the /tasks/index_document task.
+
+A shard holds at most MAX_POSTINGS documents.  A term that fills one is
+too common to narrow a search down, so the shard is marked saturated and
+stops taking documents; it also drops its token, so prefix scans no
+longer find it.  Queries then ignore the term, like a stopword, which
+keeps such shards under the entity size limit and stops every index write
+contending on them.  The placeholder values conference defaults fill in
+("Default City", "Default", "Topic") aren't indexed at all.
+
+Queries AND together their terms; a term ending in '*' matches as a
+prefix.  Results are ranked by summed term weight.
+
+"""
+
+import re
+import zlib
+
+from google.appengine.ext import ndb
+
+from models import SearchDocument, SearchTerm
+import unitofwork
+
+SEARCH_SHARDS = 8
+MAX_POSTINGS = 5000         # documents per shard; about 400KB of JSON
+PREFIX_EXPANSION = 50       # max terms a prefix expands to
+MIN_TERM_LENGTH = 2
+STOPWORDS = frozenset('a an and are as at be by for from in is it of on or '
+                      'the this to with'.split())
+# values conference.py's DEFAULTS fills in for missing fields
+PLACEHOLDERS = frozenset([u'Default City', u'Default', u'Topic'])
+
+# weight of each indexed field, by kind
+FIELD_WEIGHTS = {
+    'Conference': (('name', 3), ('topics', 2), ('city', 2),
+                   ('description', 1)),
+    'Session': (('name', 3), ('highlights', 1), ('typeOfSession', 1)),
+}
+
+
+def tokenize(text):
+    """Return lowercase terms in text, without stopwords."""
+    return [t for t in re.findall(r'\w+', text.lower(), re.UNICODE)
+            if len(t) >= MIN_TERM_LENGTH and t not in STOPWORDS]
+
+
+def documentTerms(entity):
+    """Return {term: weight} for an indexable entity."""
+    terms = {}
+    for field, weight in FIELD_WEIGHTS[entity.key.kind()]:
+        value = getattr(entity, field, None) or []
+        for text in value if isinstance(value, list) else [value]:
+            if text in PLACEHOLDERS:
+                continue
+            for term in tokenize(text):
+                terms[term] = terms.get(term, 0) + weight
+    return terms
+
+
+def _shard(websafeKey):
+    return zlib.crc32(websafeKey.encode('utf-8')) % SEARCH_SHARDS
+
+
+def _termKey(kind, term, shard):
+    return ndb.Key(SearchTerm, '%s:%s:%d' % (kind, term, shard))
+
+
+def enqueueIndex(key):
+    """Queue (re)indexing of the entity with given key.
+
+    Transactional inside a transaction; batched in a unit of work.
+    """
+    unitofwork.addTask(params={'websafeKey': key.urlsafe()},
+                       url='/tasks/index_document')
+
+
+@ndb.transactional_tasklet
+def _updatePosting(kind, term, shard, websafeKey, weight):
+    t_key = _termKey(kind, term, shard)
+    entry = yield t_key.get_async()
+    postings = (entry and entry.postings) or {}
+    if weight and websafeKey not in postings and \
+            len(postings) >= MAX_POSTINGS:
+        if not entry.saturated or entry.token:
+            entry.saturated = True
+            entry.token = None
+            yield entry.put_async()
+        return
+    if weight:
+        postings[websafeKey] = weight
+    else:
+        postings.pop(websafeKey, None)
+
+    if postings:
+        entry = entry or SearchTerm(key=t_key, token='%s:%s' % (kind, term))
+        entry.postings = postings
+        yield entry.put_async()
+    elif entry:
+        yield t_key.delete_async()
+
+
+def indexDocument(websafeKey):
+    """Bring the index up to date with the current state of a document."""
+    doc_key = ndb.Key(urlsafe=websafeKey)
+    websafeKey = doc_key.urlsafe()
+    entity, record = ndb.get_multi([doc_key,
+                                    ndb.Key(SearchDocument, websafeKey)])
+    new = documentTerms(entity) if entity else {}
+    old = (record and record.terms) or {}
+
+    # each term shard is its own small transaction; run them concurrently
+    kind, shard = doc_key.kind(), _shard(websafeKey)
+    changed = [t for t in set(old) | set(new) if old.get(t) != new.get(t)]
+    futures = [_updatePosting(kind, t, shard, websafeKey, new.get(t))
+               for t in changed]
+    ndb.Future.wait_all(futures)
+    for f in futures:
+        f.check_success()
+
+    if entity:
+        SearchDocument(id=websafeKey, terms=new).put()
+    elif record:
+        record.key.delete()
+
+
+def _postings(kind, term, prefix):
+    """Return {websafeKey: weight} for a term or term prefix.
+
+    Returns None for a saturated term; a prefix skips saturated terms.
+    """
+    if prefix:
+        token = '%s:%s' % (kind, term)
+        q = SearchTerm.query(SearchTerm.token >= token,
+                             SearchTerm.token < token + u'\ufffd')
+        # saturated shards have no token; pick keys, then get the rest
+        entries = ndb.get_multi(q.fetch(PREFIX_EXPANSION * SEARCH_SHARDS,
+                                        keys_only=True))
+    else:
+        entries = ndb.get_multi([_termKey(kind, term, shard)
+                                 for shard in range(SEARCH_SHARDS)])
+        if any(entry and entry.saturated for entry in entries):
+            return None
+    postings = {}
+    for entry in entries:
+        if entry and entry.saturated:
+            continue
+        for websafeKey, weight in ((entry and entry.postings) or {}).items():
+            postings[websafeKey] = max(weight, postings.get(websafeKey, 0))
+    return postings
+
+
+def search(kind, query):
+    """Return [(websafeKey, score)] matching all query terms, best first."""
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        tokens = tokenize(word.rstrip('*'))
+        if prefix and tokens:
+            # only the last token of e.g. "e-comm*" is a prefix
+            terms.extend((t, False) for t in tokens[:-1])
+            terms.append((tokens[-1], True))
+        else:
+            terms.extend((t, False) for t in tokens)
+    if not terms:
+        return []
+
+    # intersect posting lists, smallest first, ignoring saturated terms
+    lists = sorted((p for p in (_postings(kind, term, prefix)
+                                for term, prefix in terms) if p is not None),
+                   key=len)
+    if not lists:
+        return []
+    scores = dict(lists[0])
+    for postings in lists[1:]:
+        scores = dict((k, v + postings[k]) for k, v in scores.items()
+                      if k in postings)
+        if not scores:
+            break
+    return sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+unitofwork.py -- request-scoped batching of datastore writes and tasks
+
+Handlers decorated with @unitOfWork collect the entities they put() and
+the tasks they addTask() instead of writing each one as it happens.  When
+the handler returns, every dirty entity is written with one put_multi and
+every task with one batched add per queue.  If there are both, and few
+enough tasks to add transactionally, they go in one transaction, so tasks
+are added exactly when the entities they refer to are stored; otherwise
+the puts go first and the adds are retried on transient errors.
+Callbacks registered with callOnCommit() run once the writes are stored.
+If the handler raises, the pending work is dropped.
+
+Inside an ndb transaction, or outside a unit of work, put() and addTask()
+write immediately (tasks transactionally inside a transaction) and
+callOnCommit() defers to the transaction's commit, so helpers can use
+them whoever calls them.  put() can't return a key for an entity without
+a complete one; allocate ids first, or write such entities directly.
+
+"""
+
+import collections
+import functools
+import threading
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+MAX_TASKS_PER_ADD = 100             # taskqueue's limit per batch add
+MAX_TRANSACTIONAL_TASKS = 5         # and per transaction
+MAX_TRANSACTION_GROUPS = 25         # entity groups per xg transaction
+ADD_ATTEMPTS = 3
+
+HANDLERS = set()                    # names of @unitOfWork handlers
+
+_local = threading.local()
+
+
+class _Work(object):
+    """Entities, tasks and callbacks pending for the current request."""
+
+    def __init__(self):
+        self.entities = collections.OrderedDict()   # id(entity) -> entity
+        self.tasks = collections.OrderedDict()      # queue name -> [Task]
+        self.callbacks = []
+
+    def _transactional(self):
+        """Return True if puts and task adds fit in one transaction."""
+        groups = set(e.key.root() for e in self.entities.values() if e.key)
+        return bool(self.entities) and bool(self.tasks) and \
+            sum(len(t) for t in self.tasks.values()) <= \
+            MAX_TRANSACTIONAL_TASKS and len(groups) <= MAX_TRANSACTION_GROUPS
+
+    def _write(self, attempts=1):
+        futures = ndb.put_multi_async(list(self.entities.values()))
+        ndb.Future.wait_all(futures)
+        for f in futures:
+            f.check_success()
+        transactional = ndb.in_transaction()
+        for queueName, tasks in self.tasks.items():
+            queue = taskqueue.Queue(queueName)
+            for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+                batch = tasks[i:i + MAX_TASKS_PER_ADD]
+                for attempt in range(attempts):
+                    try:
+                        queue.add(batch, transactional=transactional)
+                        break
+                    except taskqueue.TransientError:
+                        if attempt == attempts - 1:
+                            raise
+
+    def flush(self):
+        if self._transactional():
+            ndb.transaction(self._write, xg=True)
+        else:
+            self._write(attempts=ADD_ATTEMPTS)
+        for callback in self.callbacks:
+            callback()
+
+
+def _current():
+    """Return the unit of work to defer writes to, or None."""
+    work = getattr(_local, 'work', None)
+    if work is None or ndb.in_transaction():
+        return None
+    return work
+
+
+def put(entity):
+    """Mark entity dirty; it's written when the unit of work ends."""
+    work = _current()
+    if work is None:
+        entity.put()
+    else:
+        work.entities[id(entity)] = entity
+
+
+def addTask(url, params, queue_name='default'):
+    """Queue a push task; it's added when the unit of work ends."""
+    work = _current()
+    if work is None:
+        taskqueue.add(url=url, params=params, queue_name=queue_name,
+                      transactional=ndb.in_transaction())
+    else:
+        work.tasks.setdefault(queue_name, []).append(
+            taskqueue.Task(url=url, params=params))
+
+
+def callOnCommit(callback):
+    """Run callback once the current writes are stored."""
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(callback)
+        return
+    work = _current()
+    if work is None:
+        callback()
+    else:
+        work.callbacks.append(callback)
+
+
+def unitOfWork(func):
+    """Decorator batching a handler's put() and addTask() calls."""
+    HANDLERS.add(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'work', None) is not None:
+            return func(*args, **kwargs)    # nested; outer one flushes
+        _local.work = work = _Work()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _local.work = None
+        work.flush()
+        return result
+    return wrapper